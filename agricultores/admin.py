@@ -136,6 +136,11 @@ class UserAdmin(BaseUserAdmin):
     ordering = ('phone_number',)
     filter_horizontal = ()
 
+    def save_model(self, request, obj, form, change):
+        if change and 'district' in form.changed_data:
+            obj.update_listings_geography()
+        super().save_model(request, obj, form, change)
+
 
 class SupplyAdmin(NumericFilterModelAdmin):
     list_display = (
@@ -0,0 +1,165 @@
+import threading
+from collections import defaultdict, namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+
+from agricultores import conditional
+from agricultores.models import Advertisement, LinkedTo
+
+VERSION_KEY = 'ads:version'
+
+AdEntry = namedtuple('AdEntry', [
+    'id', 'user_id', 'phone_number', 'URL', 'picture_URL', 'for_orders', 'for_publications',
+    'department_id', 'region_id', 'district_id',
+    'beginning_sowing_date', 'ending_sowing_date', 'beginning_harvest_date', 'ending_harvest_date',
+])
+
+
+def within(beginning, ending, value):
+    return (beginning is None or beginning <= value) and (ending is None or value <= ending)
+
+
+class AdIndex:
+    """
+    Per-process index of the advertisements that still have credits, keyed by supply.
+
+    Local changes are applied incrementally through the Advertisement/LinkedTo signals.
+    Changes made by other processes bump a shared version in the cache, which makes
+    this index rebuild itself on its next lookup.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.version = None
+        self.ads = {}
+        self.supplies = defaultdict(set)
+
+    def get_candidates(self, supply_id, kind, department_id, region_id, district_id, sowing_date, harvest_date):
+        with self.lock:
+            if self.version is None or self.version != cache.get(VERSION_KEY):
+                self.rebuild()
+            ads = [self.ads[ad_id] for ad_id in self.supplies.get(supply_id, ())]
+
+        return [
+            ad for ad in ads
+            if (ad.for_publications if kind == 'pub' else ad.for_orders)
+            and ad.department_id in (None, department_id)
+            and ad.region_id in (None, region_id)
+            and ad.district_id in (None, district_id)
+            and within(ad.beginning_sowing_date, ad.ending_sowing_date, sowing_date)
+            and within(ad.beginning_harvest_date, ad.ending_harvest_date, harvest_date)
+        ]
+
+    def rebuild(self):
+        with self.lock:
+            version = cache.get(VERSION_KEY)
+            if version is None:
+                cache.add(VERSION_KEY, 1, None)
+                version = cache.get(VERSION_KEY)
+            self.ads = {}
+            self.supplies = defaultdict(set)
+            self.load(Advertisement.objects.filter(remaining_credits__gt=0))
+            self.version = version
+
+    def refresh(self, ad_id):
+        "Reload one advertisement after it was created, changed or deleted, once that is committed."
+        # Before the commit (e.g. inside an admin view), another process could rebuild from the
+        # old rows and keep them under the new version
+        transaction.on_commit(lambda: self.reload(ad_id))
+
+    def reload(self, ad_id):
+        with self.lock:
+            if self.version is not None:
+                self.remove(ad_id)
+                self.load(Advertisement.objects.filter(id=ad_id, remaining_credits__gt=0))
+            self.bump()
+
+    def discard(self, ad_id):
+        "Drop an advertisement that ran out of credits, once that is committed."
+        transaction.on_commit(lambda: self.drop(ad_id))
+
+    def drop(self, ad_id):
+        with self.lock:
+            self.remove(ad_id)
+            self.bump()
+
+    def load(self, queryset):
+        ads = queryset.select_related('user')
+        for ad in ads:
+            self.ads[ad.id] = AdEntry(
+                id=ad.id, user_id=ad.user_id, phone_number=str(ad.user.phone_number), URL=ad.URL,
+                picture_URL=ad.picture_URL, for_orders=ad.for_orders, for_publications=ad.for_publications,
+                department_id=ad.department_id, region_id=ad.region_id, district_id=ad.district_id,
+                beginning_sowing_date=ad.beginning_sowing_date, ending_sowing_date=ad.ending_sowing_date,
+                beginning_harvest_date=ad.beginning_harvest_date, ending_harvest_date=ad.ending_harvest_date,
+            )
+        links = LinkedTo.objects.filter(advertisement__in=ads).values_list('supply_id', 'advertisement_id')
+        for supply_id, ad_id in links:
+            self.supplies[supply_id].add(ad_id)
+
+    def remove(self, ad_id):
+        if self.ads.pop(ad_id, None) is not None:
+            for ad_ids in self.supplies.values():
+                ad_ids.discard(ad_id)
+
+    def bump(self):
+        # Other processes rebuild on their next lookup. This one is already up to date
+        # unless someone else bumped the version in between.
+        try:
+            version = cache.incr(VERSION_KEY)
+        except ValueError:
+            self.version = None
+            return
+        if self.version is not None and version == self.version + 1:
+            self.version = version
+        else:
+            self.version = None
+
+
+ad_index = AdIndex()
+
+# Picks one of the candidate ads and spends one of its credits in the same statement.
+# The UPDATE re-checks remaining_credits on the row it locks, so concurrent impressions
+# can never take an ad below zero. The weighted order is an exponential race
+# (Efraimidis-Spirakis): each ad wins with probability proportional to its credits.
+TAKE_IMPRESSION_SQL = '''
+    UPDATE {table} SET remaining_credits = remaining_credits - 1, updated_at = now()
+    WHERE id = (
+        SELECT id FROM {table}
+        WHERE id = ANY(%s) AND remaining_credits > 0
+        ORDER BY {order}
+        LIMIT 1
+    ) AND remaining_credits > 0
+    RETURNING id, remaining_credits
+'''
+UNIFORM_ORDER = 'random()'
+WEIGHTED_ORDER = '-ln(1.0 - random()) / remaining_credits'
+
+
+def take_impression(candidates, weighted=None, attempts=2):
+    """
+    Sample one ad among `candidates` (AdEntry list) and decrement its credits with a
+    single round trip. Returns the chosen AdEntry, or None when none has credits left.
+    """
+    if weighted is None:
+        weighted = settings.ADS_WEIGHTED_BY_CREDITS
+    entries = {ad.id: ad for ad in candidates}
+    sql = TAKE_IMPRESSION_SQL.format(table=Advertisement._meta.db_table,
+                                     order=WEIGHTED_ORDER if weighted else UNIFORM_ORDER)
+    # An empty result means either every candidate is exhausted or another request took
+    # the last credit of the ad we sampled between the SELECT and the UPDATE.
+    for _ in range(attempts):
+        if not entries:
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [list(entries)])
+            row = cursor.fetchone()
+        if row is not None:
+            ad_id, remaining_credits = row
+            if remaining_credits == 0:
+                ad_index.discard(ad_id)
+            conditional.bump('advertisement', 'advertisement:user:%s' % entries[ad_id].user_id)
+            return entries[ad_id]
+    return None
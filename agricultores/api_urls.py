@@ -6,6 +6,8 @@ urlpatterns = [
     path('districts/', DistrictFilterView.as_view()),
     path('pubs/', PublishFilterView.as_view()),
     path('orders/', OrderFilterView.as_view()),
+    path('facets/', FacetFilterView.as_view()),
     path('compradores/', CompradorFilterView.as_view()),
     path('agricultores/', AgricultorFilterView.as_view()),
+    path('cache/', FilterCacheStats.as_view()),
 ]
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class AgricultoresConfig(AppConfig):
     name = 'agricultores'
+
+    def ready(self):
+        import agricultores.signals
@@ -0,0 +1,78 @@
+import hashlib
+import logging
+import re
+
+from django.db import transaction
+from django.db.models import F
+
+from agricultores.images import get_keys
+from agricultores.models import ImageBlob
+from backend.custom_storage import MediaStorage
+
+logger = logging.getLogger(__name__)
+
+# Publication pictures are stored under the sha256 of the uploaded file
+BLOB_RE = re.compile(r'^pub_pictures/(?P<digest>[0-9a-f]{64})/full\.jpeg$')
+
+
+def get_key(raw):
+    return 'pub_pictures/%s/full.jpeg' % hashlib.sha256(raw).hexdigest()
+
+
+def is_shared(key):
+    return BLOB_RE.match(key) is not None
+
+
+def acquire(key):
+    """
+    Takes a reference to the blob at `key`, creating it if needed. Returns whether its
+    objects are already stored, in which case the upload can be skipped.
+    """
+    with transaction.atomic():
+        # Waits for a release() dropping it, then creates it again
+        blob, created = ImageBlob.objects.select_for_update().get_or_create(key=key)
+        ImageBlob.objects.filter(id=blob.id).update(refs=F('refs') + 1)
+        return blob.stored
+
+
+def mark_stored(key):
+    ImageBlob.objects.filter(key=key).update(stored=True)
+
+
+def release(keys):
+    """
+    Drops a reference to the blob of each key in `keys` (once per occurrence). The
+    objects of blobs left without references, and of keys without a blob (pictures
+    uploaded before them, owned by a single row), are deleted from the storage.
+
+    The references are committed before the storage is touched, so a failed delete only
+    leaves objects orphaned. An upload of the same picture meanwhile creates a new blob
+    and encodes the picture before storing it again. Returns {key: None, or the error
+    of an object that couldn't be deleted}.
+    """
+    counts = {}
+    for key in keys:
+        counts[key] = counts.get(key, 0) + 1
+    if not counts:
+        return {}
+    with transaction.atomic():
+        # Locked in key order, two releases never wait on each other
+        blobs = {blob.key: blob for blob in ImageBlob.objects.select_for_update()
+                 .filter(key__in=counts).order_by('key')}
+        unused = [key for key in counts if key not in blobs or blobs[key].refs <= counts[key]]
+        ImageBlob.objects.filter(key__in=[key for key in unused if key in blobs]).delete()
+        for key, blob in blobs.items():
+            if key not in unused:
+                ImageBlob.objects.filter(id=blob.id).update(refs=F('refs') - counts[key])
+
+    results = {key: None for key in counts}
+    names = {key: get_keys(key) for key in unused}
+    try:
+        deleted = MediaStorage().delete_many([name for key in unused for name in names[key]])
+    except Exception as exc:
+        logger.exception('Could not delete the objects of %s', unused)
+        deleted = {name: str(exc) or type(exc).__name__ for key in unused for name in names[key]}
+    for key in unused:
+        errors = [deleted[name] for name in names[key] if deleted[name] is not None]
+        results[key] = errors[0] if errors else None
+    return results
@@ -0,0 +1,89 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.response import Response
+
+VERSION_KEY = 'filter:%s:version:%s'
+STATS_KEY = 'filter:%s:stats:%s'
+ALL_SUPPLIES = 'all'
+
+
+def get_version(namespace, supply_id=None):
+    """
+    Current version of the cached results for one supply (or for queries that don't
+    filter by supply). Bumping it orphans the old entries, which then expire.
+    """
+    key = VERSION_KEY % (namespace, supply_id or ALL_SUPPLIES)
+    version = cache.get(key)
+    if version is None:
+        # Start from the clock rather than 1 so an evicted counter can't come back
+        # to a version that still has entries cached under it.
+        cache.add(key, int(time.time() * 1000), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_versions(namespace, supply_ids):
+    for supply_id in set(supply_ids) | {ALL_SUPPLIES}:
+        key = VERSION_KEY % (namespace, supply_id)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, int(time.time() * 1000), None)
+
+
+def record(namespace, outcome):
+    key = STATS_KEY % (namespace, outcome)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 1, None)
+
+
+def get_stats(namespaces):
+    stats = {}
+    for namespace in namespaces:
+        hits = cache.get(STATS_KEY % (namespace, 'hit'), 0)
+        misses = cache.get(STATS_KEY % (namespace, 'miss'), 0)
+        stats[namespace] = {
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': round(hits / (hits + misses), 4) if hits + misses else None,
+        }
+    return stats
+
+
+def normalize_params(query_params):
+    items = sorted((key, sorted(values)) for key, values in query_params.lists() if any(values))
+    return '&'.join('%s=%s' % (key, ','.join(values)) for key, values in items)
+
+
+def get_cache_key(namespace, query_params, supply_id=None, depends_on=None):
+    versions = ','.join(str(get_version(name, supply_id)) for name in depends_on or [namespace])
+    digest = hashlib.md5(normalize_params(query_params).encode('utf-8')).hexdigest()
+    return 'filter:%s:%s:%s' % (namespace, versions, digest)
+
+
+class FilterCacheMixin:
+    """
+    Caches the list response of a filter view under its normalized query params.
+    Entries are versioned per supply, see agricultores.signals.
+    """
+    cache_namespace = None
+    cache_supply_param = 'supply'
+
+    def list(self, request, *args, **kwargs):
+        supply_id = request.query_params.get(self.cache_supply_param)
+        key = get_cache_key(self.cache_namespace, request.query_params, supply_id)
+        data = cache.get(key)
+        if data is not None:
+            record(self.cache_namespace, 'hit')
+            return Response(data)
+
+        record(self.cache_namespace, 'miss')
+        response = super().list(request, *args, **kwargs)
+        if response.status_code == 200:
+            cache.set(key, response.data, settings.FILTER_CACHE_TIMEOUT)
+        return response
@@ -0,0 +1,85 @@
+import hashlib
+import time
+from functools import partial
+
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+
+VERSION_KEY = 'resource:%s:version'
+
+
+def bump(*resources):
+    """
+    Mark `resources` as changed, e.g. bump('publish', 'publish:user:3'), once the
+    current transaction commits. A request served before the commit would otherwise
+    store the old body under the new version.
+    """
+    transaction.on_commit(partial(bump_versions, resources))
+
+
+def bump_versions(resources):
+    now = time.time()
+    for resource in resources:
+        try:
+            cache.incr(VERSION_KEY % resource)
+        except ValueError:
+            cache.add(VERSION_KEY % resource, int(now * 1000), None)
+
+
+def get_versions(resources):
+    """
+    Current version of each resource. Versions start from the clock so an evicted
+    counter can't come back to a version a client already has.
+    """
+    keys = [VERSION_KEY % resource for resource in resources]
+    values = cache.get_many(keys)
+    missing = [key for key in keys if key not in values]
+    if missing:
+        now = int(time.time() * 1000)
+        for key in missing:
+            cache.add(key, now, None)
+        values.update(cache.get_many(missing))
+    return [values[key] for key in keys]
+
+
+class ConditionalGetMixin:
+    """
+    ETag for `list` and `retrieve`, computed from the versions of `conditional_resources`
+    without touching the database, so a matching If-None-Match gets a 304 before the
+    queryset and the serializer run. There is no Last-Modified: with whole seconds, a
+    change made in the same second as the client's copy would get a 304.
+
+    `conditional_resources` are resource names bumped by agricultores.signals. `{user}`
+    is replaced with the id of the requesting user.
+    """
+    conditional_resources = ()
+
+    def get_conditional_resources(self):
+        return [resource.format(user=self.request.user.pk) for resource in self.conditional_resources]
+
+    def get_etag(self, request, versions):
+        # The representation also depends on the URL, the user and the negotiated format
+        key = repr((type(self).__name__, request.get_full_path(), request.user.pk, request.META.get('HTTP_ACCEPT'),
+                    versions))
+        return '"%s"' % hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+    def conditional(self, handler, request, *args, **kwargs):
+        versions = get_versions(self.get_conditional_resources())
+        etag = self.get_etag(request, versions)
+
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = handler(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ['Authorization', 'Accept'])
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional(super().retrieve, request, *args, **kwargs)
@@ -0,0 +1,71 @@
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connection
+
+# GROUPING(supplies_id, department_id, region_id, band) has a 0 bit for every column the
+# grouping set keeps, so each set maps to one bitmask.
+GROUPING_MASKS = {0b1111: 'total', 0b0111: 'supplies', 0b1011: 'departments', 0b1101: 'regions',
+                  0b1110: 'price_bands'}
+
+
+def get_price_bands(value):
+    if not value:
+        return sorted(settings.FACET_PRICE_BANDS)
+    bands = sorted(float(price) for price in value.split(','))
+    if not bands or len(bands) > 20:
+        raise ValueError('Invalid price bands')
+    return bands
+
+
+def get_facets(publications, orders, price_bands):
+    """
+    Counts per supply, department, region and price band for both querysets, computed
+    by a single GROUPING SETS statement over the UNION of their filtered rows.
+    """
+    parts = []
+    params = []
+    for kind, queryset in (('publications', publications), ('orders', orders)):
+        sql, query_params = queryset.order_by() \
+            .values('supplies_id', 'department_id', 'region_id', 'unit_price').query.sql_with_params()
+        parts.append("SELECT %%s AS kind, supplies_id, department_id, region_id, "
+                     "width_bucket(unit_price, %%s::double precision[]) AS band FROM (%s) AS filtered" % sql)
+        params.extend([kind, price_bands])
+        params.extend(query_params)
+
+    sql = ("SELECT kind, supplies_id, department_id, region_id, band, "
+           "GROUPING(supplies_id, department_id, region_id, band), COUNT(*) "
+           "FROM (%s) AS listings "
+           "GROUP BY GROUPING SETS ((kind), (kind, supplies_id), (kind, department_id), (kind, region_id), "
+           "(kind, band))" % ' UNION ALL '.join(parts))
+
+    facets = OrderedDict((kind, empty_facets(price_bands)) for kind in ('publications', 'orders'))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        for kind, supply_id, department_id, region_id, band, grouping, count in cursor.fetchall():
+            facet = GROUPING_MASKS[grouping]
+            if facet == 'total':
+                facets[kind]['total'] = count
+            elif facet == 'price_bands':
+                if band is not None:
+                    facets[kind]['price_bands'][band]['count'] = count
+            else:
+                value = {'supplies': supply_id, 'departments': department_id, 'regions': region_id}[facet]
+                facets[kind][facet].append({'id': value, 'count': count})
+
+    for kind in facets.values():
+        for facet in ('supplies', 'departments', 'regions'):
+            kind[facet].sort(key=lambda item: (-item['count'], item['id'] or 0))
+    return facets
+
+
+def empty_facets(price_bands):
+    # width_bucket returns 0 below the first threshold and len(price_bands) above the last.
+    edges = [None] + list(price_bands) + [None]
+    return OrderedDict([
+        ('total', 0),
+        ('supplies', []),
+        ('departments', []),
+        ('regions', []),
+        ('price_bands', [{'min': edges[i], 'max': edges[i + 1], 'count': 0} for i in range(len(edges) - 1)]),
+    ])
@@ -0,0 +1,153 @@
+import itertools
+from collections import OrderedDict, defaultdict
+
+from rest_framework import serializers
+from rest_framework.response import Response
+
+from agricultores.models import PublishPicture, Supply
+from agricultores.serializers import get_field_trees
+
+DATETIME = serializers.DateTimeField()
+
+
+class FastSerializer:
+    """
+    Read-only serialization straight from QuerySet.values(). Produces the same output as
+    the matching ModelSerializer without building a model instance and a serializer per row.
+
+    `fields` lists (output name, values() column) pairs in the ModelSerializer field order.
+    Fields whose column is None come from other tables, get_related() reads them once per
+    chunk of `chunk_size` rows. Like DynamicFieldsMixin, it takes the `?fields=` /
+    `?expand=` trees to prune them.
+    """
+    fields = ()
+    datetime_fields = ()
+    chunk_size = 2000
+
+    def __init__(self, fields=None, expand=None):
+        if fields:
+            self.fields = tuple((name, column) for name, column in self.fields if name in fields)
+        self.field_tree = fields
+        self.expand = expand
+
+    @property
+    def columns(self):
+        columns = [column for name, column in self.fields if column is not None]
+        if len(columns) < len(self.fields) and 'id' not in columns:
+            # get_related() finds the rows of the other tables by id
+            columns.append('id')
+        return columns
+
+    def values(self, queryset, *extra_columns):
+        "values() queryset with the columns to render, plus `extra_columns` e.g. for pagination."
+        return queryset.values(*self.columns, *[column for column in extra_columns if column not in self.columns])
+
+    def serialize(self, rows):
+        return list(self.iter_serialize(rows))
+
+    def iter_serialize(self, rows):
+        "Serialize rows one at a time as they are read, e.g. from QuerySet.iterator()."
+        converters = self.get_converters()
+        fields = [(name, column, converters.get(name)) for name, column in self.fields]
+        related_names = [name for name, column in self.fields if column is None]
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, self.chunk_size))
+            if not chunk:
+                return
+            related = self.get_related(related_names, [row['id'] for row in chunk]) if related_names else {}
+            for row in chunk:
+                item = OrderedDict()
+                for name, column, convert in fields:
+                    value = row[column] if column is not None else related[name].get(row['id'], [])
+                    item[name] = convert(value) if convert is not None and value is not None else value
+                yield item
+
+    def get_related(self, names, ids):
+        "{name: {row id: value}} for the fields in `names`, those whose column is None."
+        raise NotImplementedError
+
+    def get_converters(self):
+        return {name: DATETIME.to_representation for name in self.datetime_fields}
+
+
+class ListingFastSerializer(FastSerializer):
+    supply_fields = ('id', 'name', 'days_for_harvest')
+
+    def get_converters(self):
+        converters = super().get_converters()
+        if 'supplies' not in dict(self.fields) or (self.expand is not None and 'supplies' not in self.expand):
+            return converters
+        supply_tree = (self.field_tree or {}).get('supplies')
+        names = [name for name in self.supply_fields if not supply_tree or name in supply_tree]
+        supplies = {
+            supply['id']: OrderedDict((name, supply[name]) for name in names)
+            for supply in Supply.objects.values(*self.supply_fields)
+        }
+        converters['supplies'] = supplies.__getitem__
+        return converters
+
+
+class PublishFastSerializer(ListingFastSerializer):
+    fields = (
+        ('id', 'id'),
+        ('user', 'user_id'),
+        ('supplies', 'supplies_id'),
+        ('user_phone_number', 'user__phone_number'),
+        ('picture_URLs', None),
+        ('picture_variants', None),
+        ('weight_unit', 'weight_unit'),
+        ('unit_price', 'unit_price'),
+        ('area_unit', 'area_unit'),
+        ('area', 'area'),
+        ('harvest_date', 'harvest_date'),
+        ('sowing_date', 'sowing_date'),
+        ('is_sold', 'is_sold'),
+    )
+    datetime_fields = ('harvest_date', 'sowing_date')
+
+    def get_related(self, names, ids):
+        related = {name: defaultdict(list) for name in names}
+        pictures = PublishPicture.objects.filter(publish_id__in=ids).order_by('ordinal', 'id') \
+            .values_list('publish_id', 'url', 'variants')
+        for publish_id, url, variants in pictures:
+            if 'picture_URLs' in related:
+                related['picture_URLs'][publish_id].append(url)
+            if 'picture_variants' in related:
+                related['picture_variants'][publish_id].append(variants)
+        return related
+
+
+class OrderFastSerializer(ListingFastSerializer):
+    fields = (
+        ('id', 'id'),
+        ('user', 'user_id'),
+        ('supplies', 'supplies_id'),
+        ('user_phone_number', 'user__phone_number'),
+        ('weight_unit', 'weight_unit'),
+        ('unit_price', 'unit_price'),
+        ('area_unit', 'area_unit'),
+        ('area', 'area'),
+        ('desired_harvest_date', 'desired_harvest_date'),
+        ('desired_sowing_date', 'desired_sowing_date'),
+        ('is_solved', 'is_solved'),
+    )
+    datetime_fields = ('desired_harvest_date', 'desired_sowing_date')
+
+
+class FastListMixin:
+    """
+    Serves `list` through `fast_serializer_class` instead of the DRF serializer.
+    Writes and single object reads keep using `serializer_class`.
+    """
+    fast_serializer_class = None
+
+    def list(self, request, *args, **kwargs):
+        fast_serializer = self.fast_serializer_class(*get_field_trees(request))
+        keyset_columns = [name.lstrip('-') for name in getattr(self, 'keyset_ordering', ())]
+        queryset = fast_serializer.values(self.filter_queryset(self.get_queryset()), *keyset_columns)
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(fast_serializer.serialize(page))
+        return Response(fast_serializer.serialize(queryset))
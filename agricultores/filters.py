@@ -0,0 +1,35 @@
+from rest_framework.filters import BaseFilterBackend
+
+from agricultores.serializers import DynamicFieldsMixin, get_field_trees, get_query_plan
+
+
+class EagerLoadingFilterBackend(BaseFilterBackend):
+    """
+    Applies the `select_related` / `prefetch_related` lists declared on the view's
+    serializer Meta, so list views don't issue a query per row for nested objects.
+
+    With `?fields=` or `?expand=` the joins and columns are derived from the pruned
+    serializer instead, so only what is rendered is read.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        serializer_class = getattr(view, 'serializer_class', None)
+        meta = getattr(serializer_class, 'Meta', None)
+        if meta is None or getattr(queryset, '_fields', None) is not None:
+            return queryset
+
+        field_trees = get_field_trees(request)
+        if issubclass(serializer_class, DynamicFieldsMixin) and field_trees != (None, None):
+            select_related, only = get_query_plan(serializer_class(field_trees=field_trees))
+            if select_related:
+                queryset = queryset.select_related(*select_related)
+            if only is not None:
+                queryset = queryset.only(*only)
+        else:
+            select_related = getattr(meta, 'select_related', None)
+            if select_related:
+                queryset = queryset.select_related(*select_related)
+        prefetch_related = getattr(meta, 'prefetch_related', None)
+        if prefetch_related:
+            queryset = queryset.prefetch_related(*prefetch_related)
+        return queryset
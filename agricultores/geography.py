@@ -0,0 +1,132 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from rest_framework.renderers import JSONRenderer
+
+from agricultores.models import Department, Region, District
+
+VERSION_KEY = 'geography:version'
+
+
+class Rendered:
+    "A pre-rendered JSON body and the hash of its content, used as its ETag."
+    __slots__ = ('data', 'body', 'etag')
+
+    def __init__(self, data):
+        # Kept for the other formats (MessagePack, browsable API)
+        self.data = data
+        self.body = JSONRenderer().render(data)
+        self.etag = '"%s"' % hashlib.blake2b(self.body, digest_size=16).hexdigest()
+
+    def response(self, request):
+        response = get_conditional_response(request, etag=self.etag)
+        if response is None:
+            response = HttpResponse(self.body, content_type='application/json')
+        response['ETag'] = self.etag
+        patch_cache_control(response, no_cache=True)
+        return response
+
+
+EMPTY = Rendered([])
+
+
+class Geography:
+    """
+    Departments, regions and districts loaded once per process and kept as the JSON the
+    ubigeo endpoints return, byte for byte what their serializers would render.
+
+    Changes bump a shared version in the cache through the Department/Region/District
+    signals, which makes every process reload on its next request.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.departments = EMPTY
+        self.regions = EMPTY
+        self.districts = EMPTY
+        self.regions_by_department = {}
+        self.districts_by_region = {}
+
+    def check(self):
+        with self.lock:
+            version = cache.get(VERSION_KEY)
+            if version is None:
+                cache.add(VERSION_KEY, int(time.time() * 1000), None)
+                version = cache.get(VERSION_KEY)
+            if version != self.version:
+                self.load()
+                self.version = version
+
+    def load(self):
+        departments = OrderedDict(
+            (department['id'], OrderedDict([('id', department['id']), ('name', department['name'])]))
+            for department in Department.objects.order_by('id').values('id', 'name')
+        )
+        regions = OrderedDict()
+        regions_by_department = defaultdict(list)
+        for region in Region.objects.order_by('id').values('id', 'name', 'department_id'):
+            regions[region['id']] = OrderedDict([('id', region['id']), ('name', region['name'])])
+            regions_by_department[region['department_id']].append(regions[region['id']])
+
+        districts = []
+        districts_by_region = defaultdict(list)
+        for district in District.objects.order_by('id').values('id', 'name', 'region_id', 'department_id'):
+            districts.append(OrderedDict([
+                ('id', district['id']),
+                ('region', regions[district['region_id']]),
+                ('department', departments[district['department_id']]),
+                ('name', district['name']),
+            ]))
+            districts_by_region[district['region_id']].append(districts[-1])
+
+        self.departments = Rendered(list(departments.values()))
+        self.regions = Rendered(list(regions.values()))
+        self.districts = Rendered(districts)
+        self.regions_by_department = {key: Rendered(value) for key, value in regions_by_department.items()}
+        self.districts_by_region = {key: Rendered(value) for key, value in districts_by_region.items()}
+
+    def get_departments(self):
+        self.check()
+        return self.departments
+
+    def get_regions(self, department_id=None):
+        "All regions, or those of one department when `department_id` is given (as an int or a query param)."
+        self.check()
+        if department_id is None:
+            return self.regions
+        return self.get_children(self.regions_by_department, department_id)
+
+    def get_districts(self, region_id=None):
+        self.check()
+        if region_id is None:
+            return self.districts
+        return self.get_children(self.districts_by_region, region_id)
+
+    def get_children(self, children, parent_id):
+        try:
+            return children.get(int(parent_id), EMPTY)
+        except ValueError:
+            return EMPTY
+
+    def invalidate(self):
+        # After the commit (ubigeo is edited in the admin, inside a transaction): another
+        # process rebuilding before it would keep the old rows under the new version
+        transaction.on_commit(self.bump)
+
+    def bump(self):
+        with self.lock:
+            try:
+                cache.incr(VERSION_KEY)
+            except ValueError:
+                cache.add(VERSION_KEY, int(time.time() * 1000), None)
+            self.version = None
+
+
+geography = Geography()
@@ -0,0 +1,169 @@
+import re
+from io import BytesIO
+from urllib.parse import urlparse
+
+from django.conf import settings
+from PIL import ExifTags, Image
+from rest_framework.exceptions import ParseError
+
+ORIENTATION = next(tag for tag, name in ExifTags.TAGS.items() if name == 'Orientation')
+TRANSPOSITIONS = {
+    2: Image.FLIP_LEFT_RIGHT,
+    3: Image.ROTATE_180,
+    4: Image.FLIP_TOP_BOTTOM,
+    5: Image.TRANSPOSE,
+    6: Image.ROTATE_270,
+    7: Image.TRANSVERSE,
+    8: Image.ROTATE_90,
+}
+# Orientations whose stored pixels are rotated by 90 degrees
+SWAPS_AXES = {5, 6, 7, 8}
+
+# Smaller copies of each publication picture, stored next to it as <size>.<extension>
+VARIANT_SIZES = (96, 320, 1024)
+FORMATS = {
+    'jpeg': ('JPEG', 'image/jpeg', {'quality': 75, 'optimize': True, 'progressive': True}),
+    'webp': ('WEBP', 'image/webp', {'quality': 75, 'method': 4}),
+}
+# Pictures stored as pub_pictures/<token>/full.jpeg have variants, older ones don't
+VARIANTS_RE = re.compile(r'^(?P<base>.*/pub_pictures/[^/]+)/full\.jpeg$')
+
+# reduce() only goes down to this many times the target size, LANCZOS does the rest
+REDUCING_GAP = 2
+
+
+def open_image(raw):
+    """
+    Opens `raw` reading only its header. Raises ParseError for anything that isn't an
+    image or has more than IMAGES['MAX_PIXELS'] pixels, before any pixel is decoded.
+    """
+    try:
+        image = Image.open(BytesIO(raw))
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError):
+        raise ParseError('El archivo no es una imagen válida.')
+    if image.width * image.height > settings.IMAGES['MAX_PIXELS']:
+        raise ParseError('La imagen es demasiado grande.')
+    return image
+
+
+def get_orientation(image):
+    # Missing, broken or non standard EXIF blocks are common in phone pictures
+    try:
+        orientation = image.getexif().get(ORIENTATION, 1)
+    except Exception:
+        return 1
+    return orientation if orientation in TRANSPOSITIONS else 1
+
+
+def fit(size, bounds):
+    "Largest size within `bounds` with the aspect ratio of `size`, never bigger than `size`."
+    width, height = size
+    scale = min(1.0, bounds[0] / width, bounds[1] / height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def flatten(image):
+    "RGB or L, with transparent areas over white instead of black."
+    if image.mode in ('RGB', 'L'):
+        return image
+    if image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def load(raw, size=None):
+    """
+    Decodes `raw` into an upright image that fits in `size` (and in IMAGES['MAX_SIZE']).
+
+    JPEGs are decoded straight at a 1/2, 1/4 or 1/8 scale with draft(), then reduce()
+    averages whole blocks of pixels, so a 12 MP photo is never decoded or resampled at
+    full size. The EXIF rotation is applied last, on the small image.
+    """
+    limit = settings.IMAGES['MAX_SIZE']
+    bounds = (min(size[0], limit), min(size[1], limit)) if size else (limit, limit)
+
+    image = open_image(raw)
+    orientation = get_orientation(image)
+    if orientation in SWAPS_AXES:
+        bounds = bounds[::-1]
+    target = fit(image.size, bounds)
+
+    if image.format == 'JPEG':
+        image.draft('RGB' if image.mode != 'L' else 'L', target)
+    image = flatten(image)
+
+    factor = min(image.width // (target[0] * REDUCING_GAP), image.height // (target[1] * REDUCING_GAP))
+    if factor > 1:
+        image = image.reduce(factor)
+    if image.size != target:
+        image = image.resize(target, Image.LANCZOS)
+
+    if orientation != 1:
+        image = image.transpose(TRANSPOSITIONS[orientation])
+    return image
+
+
+def encode(image, extension='jpeg', **options):
+    # Saved without the EXIF block: the rotation is already applied, and it may carry GPS data
+    image_format, content_type, defaults = FORMATS[extension]
+    output = BytesIO()
+    image.save(output, format=image_format, **dict(defaults, **options))
+    return output.getvalue()
+
+
+def encode_jpeg(image, **options):
+    return encode(image, 'jpeg', **options)
+
+
+def encode_picture(raw, size=None, **options):
+    "Decodes, rotates and fits `raw` in `size`, then returns it as JPEG."
+    return encode_jpeg(load(raw, size), **options)
+
+
+def get_variant_key(base, size, extension):
+    return '%s/%d.%s' % (base, size, extension)
+
+
+def get_variants(url):
+    """
+    {size: {extension: url}} of the smaller copies of the picture at `url`, None for
+    pictures uploaded before they were generated. The keys are deterministic, nothing
+    is read from the storage.
+    """
+    match = VARIANTS_RE.match(url or '')
+    if match is None:
+        return None
+    base = match.group('base')
+    return {str(size): {extension: get_variant_key(base, size, extension) for extension in FORMATS}
+            for size in VARIANT_SIZES}
+
+
+def get_keys(url):
+    "Storage keys of the picture at `url` and of its variants."
+    path = urlparse(url).path.lstrip('/')
+    match = VARIANTS_RE.match('/' + path)
+    if match is None:
+        return [path]
+    base = match.group('base').lstrip('/')
+    return [path] + [get_variant_key(base, size, extension) for size in VARIANT_SIZES for extension in FORMATS]
+
+
+def encode_files(raw, key, size=None, variants=False, **options):
+    """
+    {key: (content, content type)} of the JPEG at `key` and, with `variants`, of its
+    smaller copies next to it. The picture is decoded once; each size is resized from
+    the previous one, largest first.
+    """
+    image = load(raw, size)
+    files = {key: (encode_jpeg(image, **options), FORMATS['jpeg'][1])}
+    if variants:
+        base = key.rsplit('/', 1)[0]
+        for variant_size in sorted(VARIANT_SIZES, reverse=True):
+            image = image.resize(fit(image.size, (variant_size, variant_size)), Image.LANCZOS) \
+                if max(image.size) > variant_size else image
+            for extension, (image_format, content_type, defaults) in FORMATS.items():
+                files[get_variant_key(base, variant_size, extension)] = (encode(image, extension), content_type)
+    return files
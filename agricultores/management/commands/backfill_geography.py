@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max, OuterRef, Subquery
+
+from agricultores.models import District, Order, Publish, User
+
+
+class Command(BaseCommand):
+    help = 'Copies the owner district, region and department onto every publication and order.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Number of ids updated per statement.')
+        parser.add_argument('--missing', action='store_true',
+                            help='Only fill rows whose district is still empty.')
+
+    def handle(self, *args, **options):
+        district_id = Subquery(User.objects.filter(id=OuterRef('user_id')).values('district_id')[:1])
+        district = District.objects.filter(users__id=OuterRef('user_id'))
+        geography = {
+            'district_id': district_id,
+            'region_id': Subquery(district.values('region_id')[:1]),
+            'department_id': Subquery(district.values('department_id')[:1]),
+        }
+
+        for model in (Publish, Order):
+            queryset = model.objects.all()
+            if options['missing']:
+                queryset = queryset.filter(district__isnull=True, user__district__isnull=False)
+            last_id = queryset.aggregate(last=Max('id'))['last'] or 0
+            updated = 0
+            for start in range(0, last_id, options['batch_size']):
+                batch = queryset.filter(id__gt=start, id__lte=start + options['batch_size'])
+                updated += batch.update(**geography)
+            self.stdout.write('%s: %d rows updated' % (model._meta.verbose_name_plural, updated))
@@ -0,0 +1,59 @@
+import hashlib
+
+from django.core.management.base import BaseCommand
+
+from agricultores import blobs
+from agricultores.images import encode_files, get_variants
+from agricultores.models import PublishPicture
+from agricultores.pipeline import get_url, touch_pub, upload
+from backend.custom_storage import MediaStorage
+
+
+class Command(BaseCommand):
+    help = 'Moves the publication pictures uploaded before the variants existed to pub_pictures/<sha256>/full.jpeg ' \
+           'and generates their smaller copies, unless that picture is already stored. The old objects are left ' \
+           'in place for cached clients.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=None, help='Stop after this many pictures.')
+
+    def handle(self, *args, **options):
+        media_storage = MediaStorage()
+        pictures = PublishPicture.objects.filter(variants__isnull=True).order_by('id')
+        if options['limit'] is not None:
+            pictures = pictures[:options['limit']]
+        done = failed = 0
+        for picture in pictures.iterator():
+            try:
+                with media_storage.open(picture.key) as file:
+                    raw = file.read()
+            except Exception as exc:
+                failed += 1
+                self.stderr.write('%s: %s' % (picture.url, exc))
+                continue
+            key = blobs.get_key(raw)
+            if not blobs.acquire(key):
+                try:
+                    files = encode_files(raw, key, variants=True)
+                    # The picture itself is copied as is, encoding it again would only lose quality
+                    files[key] = (raw, files[key][1])
+                    for name, (content, content_type) in files.items():
+                        upload(name, content, content_type)
+                except Exception as exc:
+                    blobs.release([key])
+                    failed += 1
+                    self.stderr.write('%s: %s' % (picture.url, exc))
+                    continue
+                blobs.mark_stored(key)
+            url = get_url(key)
+            if PublishPicture.objects.filter(publish_id=picture.publish_id, key=key).exists():
+                # The publication has the same photo twice, the legacy copy goes
+                PublishPicture.objects.filter(id=picture.id).delete()
+                blobs.release([key])
+            else:
+                # Only this row is written, the publication just gets a new updated_at
+                PublishPicture.objects.filter(id=picture.id).update(key=key, url=url, variants=get_variants(url),
+                                                                   content_hash=hashlib.sha256(raw).hexdigest())
+            touch_pub(picture.publish_id)
+            done += 1
+        self.stdout.write('%d pictures moved, %d failed' % (done, failed))
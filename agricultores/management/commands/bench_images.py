@@ -0,0 +1,123 @@
+import multiprocessing
+import os
+import resource
+import time
+from io import BytesIO
+
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image
+
+from agricultores import images
+
+EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.heic')
+
+
+def decode_full(raw, size):
+    "What the upload views did before agricultores.images: decode everything, then shrink."
+    image = Image.open(BytesIO(raw))
+    image.load()
+    orientation = images.get_orientation(image)
+    image = images.flatten(image)
+    image.thumbnail(size, Image.LANCZOS, reducing_gap=None)
+    if orientation != 1:
+        image = image.transpose(images.TRANSPOSITIONS[orientation])
+    return image
+
+
+def decode_draft(raw, size):
+    return images.load(raw, size)
+
+
+def reset_peak_rss():
+    "Resets the peak RSS of this process to its current RSS, Linux only."
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        pass
+
+
+def get_peak_rss():
+    "Peak RSS of this process in KB."
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(decode, corpus, size, repeat, connection):
+    # Runs in a fresh interpreter, a forked one would reuse the memory the parent already freed
+    reset_peak_rss()
+    baseline = get_peak_rss()
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = 0
+        for raw in corpus:
+            output += len(images.encode_jpeg(decode(raw, size), quality=80))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    peak = get_peak_rss() - baseline
+    connection.send((best, peak, output))
+    connection.close()
+
+
+class Command(BaseCommand):
+    help = 'Compares ms/image and peak RSS of decoding pictures fully before shrinking them and of the ' \
+           'draft()/reduce() path of agricultores.images. Takes files or directories of phone photos; ' \
+           'without them, synthetic 12 MP JPEGs are used.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help='Pictures or directories of pictures.')
+        parser.add_argument('--synthetic', type=int, default=10, help='Synthetic photos when no path is given.')
+        parser.add_argument('--size', type=int, default=500, help='Longest side of the output.')
+        parser.add_argument('--repeat', type=int, default=3, help='Runs per variant, the best one is kept.')
+
+    def handle(self, *args, **options):
+        corpus = self.load_corpus(options['paths']) if options['paths'] else self.synthesize(options['synthetic'])
+        if not corpus:
+            raise CommandError('No pictures found.')
+        megapixels = sum(Image.open(BytesIO(raw)).width * Image.open(BytesIO(raw)).height for raw in corpus)
+        self.stdout.write('%d pictures, %.1f MP on average, output fits in %dpx' % (
+            len(corpus), megapixels / len(corpus) / 1e6, options['size']))
+
+        size = (options['size'], options['size'])
+        context = multiprocessing.get_context('spawn')
+        for name, decode in [('full decode', decode_full), ('draft/reduce', decode_draft)]:
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=measure, args=(decode, corpus, size, options['repeat'], sender))
+            process.start()
+            elapsed, peak, output = receiver.recv()
+            process.join()
+            self.stdout.write('  %-14s %8.1f ms/image  peak RSS +%7.1f MB  %6.1f KB/image' % (
+                name, elapsed * 1000 / len(corpus), peak / 1024, output / 1024 / len(corpus)))
+
+    def load_corpus(self, paths):
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                files.extend(os.path.join(root, name) for root, dirs, names in os.walk(path) for name in names
+                             if name.lower().endswith(EXTENSIONS))
+            else:
+                files.append(path)
+        corpus = []
+        for path in sorted(files):
+            with open(path, 'rb') as file:
+                corpus.append(file.read())
+        return corpus
+
+    def synthesize(self, count):
+        corpus = []
+        for i in range(count):
+            # Noise scaled up looks more like a photo to the encoder than a flat color
+            bands = [Image.effect_noise((1008, 756), 40 + i).resize((4032, 3024), Image.BICUBIC) for _ in range(3)]
+            exif = Image.Exif()
+            exif[images.ORIENTATION] = 6 if i % 2 else 1
+            output = BytesIO()
+            Image.merge('RGB', bands).save(output, format='JPEG', quality=90, exif=exif.tobytes())
+            corpus.append(output.getvalue())
+        return corpus
@@ -0,0 +1,72 @@
+import io
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from agricultores.management.commands.bench_serializers import Command as BenchSerializers, Rollback
+from agricultores.models import Advertisement, District, Order, Publish, User
+from agricultores.renderers import MessagePackParser, MessagePackRenderer
+from agricultores.serializers import AdvertisementSerializer, DistrictSerializer, OrderSerializer, \
+    PublishSerializer, UserSerializer
+
+
+class Command(BaseCommand):
+    help = 'Compares payload size and encode time of the JSON and MessagePack renderers on the existing ' \
+           'serializers. With --seed, synthetic rows are created inside a transaction that is rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0, help='Synthetic publications and orders to add.')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per renderer, the best one is kept.')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                if options['seed']:
+                    BenchSerializers(stdout=self.stdout).seed(options['seed'])
+                self.run(options['repeat'])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def run(self, repeat):
+        cases = [
+            ('Publish', Publish, PublishSerializer),
+            ('Order', Order, OrderSerializer),
+            ('User', User, UserSerializer),
+            ('Advertisement', Advertisement, AdvertisementSerializer),
+            ('District', District, DistrictSerializer),
+        ]
+        renderers = [('json', JSONRenderer()), ('msgpack', MessagePackRenderer())]
+        for name, model, serializer_class in cases:
+            queryset = model.objects.order_by('id').select_related(*serializer_class.Meta.select_related)
+            data = serializer_class(queryset, many=True).data
+            if not data:
+                self.stdout.write('%s: no rows, use --seed' % name)
+                continue
+
+            self.stdout.write('%s (%d rows)' % (name, len(data)))
+            json_size = None
+            for renderer_name, renderer in renderers:
+                elapsed, body = self.measure(lambda: renderer.render(data), repeat)
+                json_size = json_size or len(body)
+                self.stdout.write('  %-8s %10d bytes (%5.1f%%)  %8.2f ms' % (
+                    renderer_name, len(body), 100.0 * len(body) / json_size, elapsed * 1000))
+
+            parsed = MessagePackParser().parse(io.BytesIO(MessagePackRenderer().render(data)))
+            if parsed == json.loads(JSONRenderer().render(data)):
+                self.stdout.write(self.style.SUCCESS('  msgpack decodes to the same data'))
+            else:
+                self.stdout.write(self.style.ERROR('  msgpack decodes to different data'))
+
+    def measure(self, function, repeat):
+        best, body = None, None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            body = function()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best, body
+
@@ -0,0 +1,95 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from agricultores.fast_serializers import PublishFastSerializer, OrderFastSerializer
+from agricultores.models import Order, Publish, PublishPicture, Supply, User
+from agricultores.serializers import PublishSerializer, OrderSerializer
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Compares rows/sec of the DRF serializers and the values() fast path for publications and orders. ' \
+           'With --seed, synthetic rows are created inside a transaction that is rolled back at the end.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0, help='Synthetic publications and orders to add.')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per serializer, the best one is kept.')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                if options['seed']:
+                    self.seed(options['seed'])
+                self.run(options['repeat'])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def seed(self, count):
+        user = User.objects.first()
+        supplies = list(Supply.objects.all())
+        if user is None or not supplies:
+            raise CommandError('Load the fixtures first (poblarDB.sh).')
+        now = timezone.now()
+        pubs = Publish.objects.bulk_create([
+            Publish(user=user, supplies=supplies[i % len(supplies)], weight_unit='kg', unit_price=i % 50,
+                    area_unit='hm2', area=1, harvest_date=now, sowing_date=now)
+            for i in range(count)
+        ])
+        PublishPicture.objects.bulk_create([
+            PublishPicture(publish=pub, key='pub_pictures/%d' % i,
+                           url='https://cosecha-app.s3.amazonaws.com/pub_pictures/%d' % i)
+            for i, pub in enumerate(pubs)
+        ])
+        Order.objects.bulk_create([
+            Order(user=user, supplies=supplies[i % len(supplies)], weight_unit='kg', unit_price=i % 50,
+                  area_unit='hm2', area=1, desired_harvest_date=now, desired_sowing_date=now)
+            for i in range(count)
+        ])
+
+    def run(self, repeat):
+        renderer = JSONRenderer()
+        cases = [
+            ('Publish', Publish, PublishSerializer, PublishFastSerializer),
+            ('Order', Order, OrderSerializer, OrderFastSerializer),
+        ]
+        for name, model, serializer_class, fast_serializer_class in cases:
+            queryset = model.objects.order_by('id')
+            rows = queryset.count()
+            if not rows:
+                self.stdout.write('%s: no rows, use --seed' % name)
+                continue
+
+            def drf():
+                queryset_ = queryset.select_related(*serializer_class.Meta.select_related)
+                return renderer.render(serializer_class(queryset_, many=True).data)
+
+            def fast():
+                serializer = fast_serializer_class()
+                return renderer.render(serializer.serialize(serializer.values(queryset)))
+
+            drf_time, drf_body = self.measure(drf, repeat)
+            fast_time, fast_body = self.measure(fast, repeat)
+            self.stdout.write('%s (%d rows)' % (name, rows))
+            self.stdout.write('  serializer: %10.0f rows/s' % (rows / drf_time))
+            self.stdout.write('  values():   %10.0f rows/s  (x%.1f)' % (rows / fast_time, drf_time / fast_time))
+            if drf_body == fast_body:
+                self.stdout.write(self.style.SUCCESS('  output is byte-identical'))
+            else:
+                self.stdout.write(self.style.ERROR('  output differs'))
+
+    def measure(self, function, repeat):
+        best, body = None, None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            body = function()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best, body
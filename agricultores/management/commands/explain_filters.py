@@ -0,0 +1,94 @@
+import re
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from agricultores.models import Order, Publish
+from agricultores.views import PublishFilterView, OrderFilterView, EstimatePublic, GetMySuggestions, \
+    GetMyProspects
+
+WATCHED_TABLES = (Publish._meta.db_table, Order._meta.db_table)
+SEQ_SCAN = re.compile(r'Seq Scan on (\w+)')
+
+
+class Command(BaseCommand):
+    help = 'Runs EXPLAIN on the SQL generated by the marketplace filter views and fails if any of them ' \
+           'falls back to a sequential scan on the publish/order tables. Run it against a database ' \
+           'seeded with poblarDB.sh.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verbose-plans', action='store_true', help='Print every query plan.')
+
+    def handle(self, *args, **options):
+        publish = Publish.objects.select_related('user').first()
+        order = Order.objects.select_related('user').first()
+        if publish is None or order is None:
+            raise CommandError('Seed the database first (poblarDB.sh): at least one publication and order.')
+
+        supply = publish.supplies_id
+        cases = [
+            ('PublishFilterView', PublishFilterView, '/api/filter/pubs/', {}, None),
+            ('PublishFilterView supply', PublishFilterView, '/api/filter/pubs/', {'supply': supply}, None),
+            ('PublishFilterView price', PublishFilterView, '/api/filter/pubs/',
+             {'supply': supply, 'min_price': 0, 'max_price': 100}, None),
+            ('PublishFilterView department', PublishFilterView, '/api/filter/pubs/',
+             {'supply': supply, 'department': publish.department_id or 1}, None),
+            ('OrderFilterView', OrderFilterView, '/api/filter/orders/', {}, None),
+            ('OrderFilterView supply', OrderFilterView, '/api/filter/orders/', {'supply': supply}, None),
+            ('OrderFilterView price', OrderFilterView, '/api/filter/orders/',
+             {'supply': supply, 'min_price': 0, 'max_price': 100}, None),
+            ('OrderFilterView region', OrderFilterView, '/api/filter/orders/',
+             {'region': order.region_id or 1}, None),
+            ('EstimatePublic', EstimatePublic, '/estimatePublic/', {'supplies': supply}, publish.user),
+            ('GetMySuggestions', GetMySuggestions, '/mySuggestions/', {}, order.user),
+            ('GetMyProspects', GetMyProspects, '/myProspects/', {}, publish.user),
+        ]
+
+        failures = []
+        for name, view_class, path, params, user in cases:
+            scanned = []
+            for sql in self.capture_queries(view_class, path, params, user):
+                plan = self.explain(sql)
+                if options['verbose_plans']:
+                    self.stdout.write('%s\n%s\n%s\n' % (name, sql, plan))
+                tables = [table for table in SEQ_SCAN.findall(plan) if table in WATCHED_TABLES]
+                if tables:
+                    failures.append((name, sql, plan))
+                    scanned.extend(tables)
+            if scanned:
+                self.stdout.write(self.style.ERROR('%s: sequential scan on %s' % (name, ', '.join(scanned))))
+            else:
+                self.stdout.write('%s: OK' % name)
+
+        if failures:
+            for name, sql, plan in failures:
+                self.stderr.write('\n%s\n%s\n%s' % (name, sql, plan))
+            raise CommandError('%d queries fall back to a sequential scan.' % len(failures))
+        self.stdout.write(self.style.SUCCESS('All filter queries use an index.'))
+
+    def capture_queries(self, view_class, path, params, user):
+        # A throwaway param keeps the filter cache from answering without touching the database.
+        request = APIRequestFactory().get(path, dict(params, nocache=uuid.uuid4().hex))
+        if user is not None:
+            force_authenticate(request, user=user)
+        with CaptureQueriesContext(connection) as context:
+            response = view_class.as_view()(request)
+            if hasattr(response, 'render'):
+                response.render()
+        if response.status_code != 200:
+            raise CommandError('%s returned %s' % (path, response.status_code))
+        return [
+            query['sql'] for query in context.captured_queries
+            if query['sql'].startswith('SELECT') and any(table in query['sql'] for table in WATCHED_TABLES)
+        ]
+
+    def explain(self, sql):
+        # With sequential scans priced out the planner only picks one when no index can
+        # serve the query, which is what we want to catch regardless of table size.
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + sql)
+            return '\n'.join(row[0] for row in cursor.fetchall())
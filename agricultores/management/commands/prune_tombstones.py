@@ -0,0 +1,16 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from agricultores.models import Tombstone
+
+
+class Command(BaseCommand):
+    help = 'Deletes the tombstones older than SYNC["TOMBSTONE_DAYS"]. Sync tokens that old are rejected anyway.'
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - datetime.timedelta(days=settings.SYNC['TOMBSTONE_DAYS'])
+        deleted, _ = Tombstone.objects.filter(deleted_at__lt=cutoff).delete()
+        self.stdout.write('%d tombstones deleted' % deleted)
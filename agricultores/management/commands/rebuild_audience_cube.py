@@ -0,0 +1,26 @@
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from agricultores.models import AudienceCell, Order, Publish
+
+
+class Command(BaseCommand):
+    help = 'Recomputes every audience cube cell from the open publications and orders.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Listings read per query.')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            AudienceCell.objects.all().delete()
+            for model in (Publish, Order):
+                listings = model.objects.filter(**{model.closed_field: False}) \
+                    .values(*model.get_audience_columns())
+                counts = Counter(model.get_audience_cell(values)
+                                 for values in listings.iterator(chunk_size=options['batch_size']))
+                AudienceCell.apply(counts)
+                self.stdout.write('%s: %d listings in %d cells' % (
+                    model._meta.verbose_name_plural, sum(counts.values()), len(counts)))
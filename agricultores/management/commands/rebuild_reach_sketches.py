@@ -0,0 +1,35 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from agricultores import sketches
+from agricultores.models import Order, Publish, ReachSketch
+
+
+class Command(BaseCommand):
+    help = 'Recomputes every reach sketch from the open publications and orders, ' \
+           'dropping the users of listings that were closed, deleted or moved.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Listings read per query.')
+
+    def handle(self, *args, **options):
+        cells = defaultdict(set)
+        for model in (Publish, Order):
+            listings = model.objects.filter(**{model.closed_field: False}) \
+                .values_list('supplies_id', 'district_id', 'region_id', 'department_id', 'user_id').distinct()
+            for supply_id, district_id, region_id, department_id, user_id in \
+                    listings.iterator(chunk_size=options['batch_size']):
+                cells[(model.audience_kind, supply_id, district_id or 0, region_id or 0, department_id or 0)] \
+                    .add(user_id)
+
+        with transaction.atomic():
+            ReachSketch.objects.all().delete()
+            ReachSketch.objects.bulk_create([
+                ReachSketch(kind=kind, supply_id=supply_id, district_id=district_id, region_id=region_id,
+                            department_id=department_id, registers=sketches.add(sketches.empty(), user_ids))
+                for (kind, supply_id, district_id, region_id, department_id), user_ids in cells.items()
+            ], batch_size=1000)
+        self.stdout.write('%d sketches rebuilt' % len(cells))
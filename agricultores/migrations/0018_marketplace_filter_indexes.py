@@ -0,0 +1,45 @@
+# Generated by Django 3.1.5 on 2026-10-18 19:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agricultores', '0017_auto_20210517_1440'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(is_solved=False), fields=['desired_harvest_date', 'id'], name='order_open_harvest_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(is_solved=False), fields=['supplies', 'desired_harvest_date'], name='order_open_supply_harvest_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(is_solved=False), fields=['supplies', 'desired_sowing_date'], name='order_open_supply_sowing_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(is_solved=False), fields=['supplies', 'unit_price'], name='order_open_supply_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='publish',
+            index=models.Index(condition=models.Q(is_sold=False), fields=['harvest_date', 'id'], name='pub_open_harvest_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='publish',
+            index=models.Index(condition=models.Q(is_sold=False), fields=['supplies', 'harvest_date'], name='pub_open_supply_harvest_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='publish',
+            index=models.Index(condition=models.Q(is_sold=False), fields=['supplies', 'sowing_date'], name='pub_open_supply_sowing_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='publish',
+            index=models.Index(condition=models.Q(is_sold=False), fields=['supplies', 'unit_price'], name='pub_open_supply_price_idx'),
+        ),
+    ]
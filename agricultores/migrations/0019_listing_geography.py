@@ -0,0 +1,44 @@
+# Generated by Django 3.1.5 on 2026-10-18 19:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agricultores', '0018_marketplace_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='department',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='orders', to='agricultores.department'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='district',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='orders', to='agricultores.district'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='region',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='orders', to='agricultores.region'),
+        ),
+        migrations.AddField(
+            model_name='publish',
+            name='department',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='publications', to='agricultores.department'),
+        ),
+        migrations.AddField(
+            model_name='publish',
+            name='district',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='publications', to='agricultores.district'),
+        ),
+        migrations.AddField(
+            model_name='publish',
+            name='region',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='publications', to='agricultores.region'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.1.5 on 2026-10-18 19:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agricultores', '0019_listing_geography'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AudienceCell',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('pub', 'Cultivo'), ('order', 'Pedido')], max_length=5)),
+                ('supply_id', models.IntegerField()),
+                ('department_id', models.IntegerField(default=0)),
+                ('region_id', models.IntegerField(default=0)),
+                ('district_id', models.IntegerField(default=0)),
+                ('sowing_month', models.DateField()),
+                ('harvest_month', models.DateField()),
+                ('count', models.IntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Celda de audiencia',
+                'verbose_name_plural': 'Celdas de audiencia',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='audiencecell',
+            constraint=models.UniqueConstraint(fields=('kind', 'supply_id', 'department_id', 'region_id', 'district_id', 'sowing_month', 'harvest_month'), name='audience_cell_unique'),
+        ),
+    ]
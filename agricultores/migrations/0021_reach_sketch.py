@@ -0,0 +1,34 @@
+# Generated by Django 3.1.5 on 2026-10-18 19:15
+
+import agricultores.sketches
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agricultores', '0020_audience_cube'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReachSketch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('pub', 'Cultivo'), ('order', 'Pedido')], max_length=5)),
+                ('supply_id', models.IntegerField()),
+                ('district_id', models.IntegerField(default=0)),
+                ('region_id', models.IntegerField(default=0)),
+                ('department_id', models.IntegerField(default=0)),
+                ('registers', models.BinaryField(default=agricultores.sketches.empty)),
+            ],
+            options={
+                'verbose_name': 'Sketch de alcance',
+                'verbose_name_plural': 'Sketches de alcance',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='reachsketch',
+            constraint=models.UniqueConstraint(fields=('kind', 'supply_id', 'district_id'), name='reach_sketch_unique'),
+        ),
+    ]
@@ -0,0 +1,85 @@
+# Generated by Django 3.1.5 on 2026-10-18 19:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+import re
+from urllib.parse import urlparse
+
+# Same layout as agricultores.images at the time of this migration
+VARIANTS_RE = re.compile(r'^(?P<base>.*/pub_pictures/[^/]+)/full\.jpeg$')
+VARIANT_SIZES = (96, 320, 1024)
+EXTENSIONS = ('jpeg', 'webp')
+BATCH_SIZE = 1000
+
+
+def get_variants(url):
+    match = VARIANTS_RE.match(url)
+    if match is None:
+        return None
+    return {str(size): {extension: '%s/%d.%s' % (match.group('base'), size, extension) for extension in EXTENSIONS}
+            for size in VARIANT_SIZES}
+
+
+def copy_picture_urls(apps, schema_editor):
+    Publish = apps.get_model('agricultores', 'Publish')
+    PublishPicture = apps.get_model('agricultores', 'PublishPicture')
+    pictures = []
+    for pub_id, urls in Publish.objects.exclude(picture_URLs=[]).values_list('id', 'picture_URLs').iterator():
+        # One row per key, URLs differing only in the host or the query string are the same object
+        keys = {}
+        for url in urls or []:
+            if url:
+                keys.setdefault(urlparse(url).path.lstrip('/'), url)
+        for ordinal, (key, url) in enumerate(keys.items()):
+            pictures.append(PublishPicture(publish_id=pub_id, ordinal=ordinal, key=key, url=url,
+                                           variants=get_variants(url)))
+        if len(pictures) >= BATCH_SIZE:
+            PublishPicture.objects.bulk_create(pictures)
+            pictures = []
+    PublishPicture.objects.bulk_create(pictures)
+
+
+def copy_pictures_back(apps, schema_editor):
+    Publish = apps.get_model('agricultores', 'Publish')
+    PublishPicture = apps.get_model('agricultores', 'PublishPicture')
+    urls = {}
+    for pub_id, url in PublishPicture.objects.order_by('publish_id', 'ordinal', 'id').values_list('publish_id', 'url'):
+        urls.setdefault(pub_id, []).append(url)
+    for pub_id, pub_urls in urls.items():
+        Publish.objects.filter(id=pub_id).update(picture_URLs=pub_urls)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agricultores', '0022_sync'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PublishPicture',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ordinal', models.PositiveIntegerField(default=0)),
+                ('key', models.CharField(max_length=255)),
+                ('url', models.URLField(max_length=500)),
+                ('variants', models.JSONField(blank=True, null=True)),
+                ('content_hash', models.CharField(blank=True, max_length=64)),
+                ('publish', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pictures', to='agricultores.publish')),
+            ],
+            options={
+                'verbose_name': 'Foto de cultivo',
+                'verbose_name_plural': 'Fotos de cultivos',
+                'ordering': ['ordinal', 'id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='publishpicture',
+            index=models.Index(fields=['publish', 'ordinal', 'id'], name='publish_picture_order_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='publishpicture',
+            constraint=models.UniqueConstraint(fields=('publish', 'key'), name='publish_picture_unique_key'),
+        ),
+        migrations.RunPython(copy_picture_urls, copy_pictures_back),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.1.5 on 2026-10-18 19:43
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agricultores', '0023_publish_picture'),
+    ]
+
+    operations = [
+        # With a default, migrating back can add the column to existing rows
+        migrations.AlterField(
+            model_name='publish',
+            name='picture_URLs',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.URLField(blank=True, null=True),
+                                                            blank=True, default=list, size=None),
+        ),
+        migrations.RemoveField(
+            model_name='publish',
+            name='picture_URLs',
+        ),
+    ]
@@ -1,12 +1,16 @@
 import datetime
+from collections import Counter
+from django.utils import timezone
 from django.utils.timezone import now
-from django.db import models
-from django.contrib.postgres.fields import ArrayField
+from django.db import connection, models, transaction
+from django.db.models import Q
 from django.contrib.auth.models import (
     BaseUserManager, AbstractBaseUser
 )
 from phonenumber_field.modelfields import PhoneNumberField
 
+from agricultores import sketches
+
 
 # Create your models here.
 
@@ -82,6 +86,7 @@ class User(AbstractBaseUser):
     is_active = models.BooleanField(default=True)
     is_admin = models.BooleanField(default=False)
     is_verified = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
     objects = UserManager()
 
     USERNAME_FIELD = 'phone_number'
@@ -106,9 +111,21 @@ class User(AbstractBaseUser):
         # Simplest possible answer: All admins are staff
         return self.is_admin
 
+    def update_listings_geography(self):
+        "Copy the user's current district to all of their publications and orders."
+        geography = Listing.get_geography(self.district)
+        for model in (Publish, Order):
+            listings = model.objects.filter(user=self)
+            AudienceCell.move_listings(model, listings, geography)
+            ReachSketch.move_listings(model, listings, geography)
+            listings.update(**geography)
+
     class Meta:
         verbose_name = 'Usuario'
         verbose_name_plural = 'Usuarios'
+        indexes = [
+            models.Index(fields=['updated_at', 'id'], name='user_updated_idx'),
+        ]
 
 
 class Supply(models.Model):
@@ -145,11 +162,15 @@ class Advertisement(models.Model):
     ending_sowing_date = models.DateTimeField(blank=True, null=True)
     beginning_harvest_date = models.DateTimeField(blank=True, null=True)
     ending_harvest_date = models.DateTimeField(blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         verbose_name = 'Anuncio'
         verbose_name_plural = 'Anuncios'
         ordering = ["user"]
+        indexes = [
+            models.Index(fields=['user', 'updated_at', 'id'], name='ad_user_updated_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.phone_number}" + ": " + f"{self.name}"
@@ -174,7 +195,55 @@ AREA_UNITS = [
 ]
 
 
-class Order(models.Model):
+class Listing(models.Model):
+    """
+    Behaviour shared by publications and orders. Their district, region and department
+    are copied from the owner on save so the marketplace filters don't have to join
+    through User and District.
+    """
+    audience_kind = None
+    sowing_date_field = None
+    harvest_date_field = None
+    closed_field = None
+
+    class Meta:
+        abstract = True
+
+    @staticmethod
+    def get_geography(district):
+        if district is None:
+            return {'district_id': None, 'region_id': None, 'department_id': None}
+        return {'district_id': district.id, 'region_id': district.region_id, 'department_id': district.department_id}
+
+    @classmethod
+    def get_audience_columns(cls):
+        return ['supplies_id', 'department_id', 'region_id', 'district_id', cls.sowing_date_field,
+                cls.harvest_date_field, cls.closed_field]
+
+    @classmethod
+    def get_audience_cell(cls, values):
+        "Key of the AudienceCell a listing counts in, from its audience columns. None once closed."
+        if values[cls.closed_field]:
+            return None
+        return (cls.audience_kind, values['supplies_id'], values['department_id'] or 0, values['region_id'] or 0,
+                values['district_id'] or 0, AudienceCell.get_month(values[cls.sowing_date_field]),
+                AudienceCell.get_month(values[cls.harvest_date_field]))
+
+    def get_audience_values(self):
+        return {column: getattr(self, column) for column in self.get_audience_columns()}
+
+    def save(self, *args, **kwargs):
+        for name, value in self.get_geography(self.user.district).items():
+            setattr(self, name, value)
+        super().save(*args, **kwargs)
+
+
+class Order(Listing):
+    audience_kind = 'order'
+    sowing_date_field = 'desired_sowing_date'
+    harvest_date_field = 'desired_harvest_date'
+    closed_field = 'is_solved'
+
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     supplies = models.ForeignKey(Supply, on_delete=models.CASCADE)
     weight_unit = models.CharField(max_length=3, choices=WEIGHT_UNITS)
@@ -184,6 +253,13 @@ class Order(models.Model):
     desired_harvest_date = models.DateTimeField()
     desired_sowing_date = models.DateTimeField()
     is_solved = models.BooleanField(default=False)
+    district = models.ForeignKey(District, related_name='orders', on_delete=models.SET_NULL, null=True, blank=True,
+                                 editable=False)
+    region = models.ForeignKey(Region, related_name='orders', on_delete=models.SET_NULL, null=True, blank=True,
+                               editable=False)
+    department = models.ForeignKey(Department, related_name='orders', on_delete=models.SET_NULL, null=True,
+                                   blank=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"{self.supplies}"
@@ -191,9 +267,25 @@ class Order(models.Model):
     class Meta:
         verbose_name = 'Pedido'
         verbose_name_plural = 'Pedidos'
+        indexes = [
+            models.Index(fields=['desired_harvest_date', 'id'], condition=Q(is_solved=False),
+                         name='order_open_harvest_idx'),
+            models.Index(fields=['supplies', 'desired_harvest_date'], condition=Q(is_solved=False),
+                         name='order_open_supply_harvest_idx'),
+            models.Index(fields=['supplies', 'desired_sowing_date'], condition=Q(is_solved=False),
+                         name='order_open_supply_sowing_idx'),
+            models.Index(fields=['supplies', 'unit_price'], condition=Q(is_solved=False),
+                         name='order_open_supply_price_idx'),
+            models.Index(fields=['updated_at', 'id'], name='order_updated_idx'),
+        ]
+
+
+class Publish(Listing):
+    audience_kind = 'pub'
+    sowing_date_field = 'sowing_date'
+    harvest_date_field = 'harvest_date'
+    closed_field = 'is_sold'
 
-
-class Publish(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     supplies = models.ForeignKey(Supply, on_delete=models.CASCADE)
     weight_unit = models.CharField(max_length=3, choices=WEIGHT_UNITS)
@@ -202,8 +294,14 @@ class Publish(models.Model):
     area = models.FloatField()
     harvest_date = models.DateTimeField()
     sowing_date = models.DateTimeField()
-    picture_URLs = ArrayField(models.URLField(null=True, blank=True), blank=True)
     is_sold = models.BooleanField(default=False)
+    district = models.ForeignKey(District, related_name='publications', on_delete=models.SET_NULL, null=True,
+                                 blank=True, editable=False)
+    region = models.ForeignKey(Region, related_name='publications', on_delete=models.SET_NULL, null=True, blank=True,
+                               editable=False)
+    department = models.ForeignKey(Department, related_name='publications', on_delete=models.SET_NULL, null=True,
+                                   blank=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"{self.supplies}"
@@ -211,3 +309,246 @@ class Publish(models.Model):
     class Meta:
         verbose_name = 'Cultivo'
         verbose_name_plural = 'Cultivos'
+        indexes = [
+            models.Index(fields=['harvest_date', 'id'], condition=Q(is_sold=False),
+                         name='pub_open_harvest_idx'),
+            models.Index(fields=['supplies', 'harvest_date'], condition=Q(is_sold=False),
+                         name='pub_open_supply_harvest_idx'),
+            models.Index(fields=['supplies', 'sowing_date'], condition=Q(is_sold=False),
+                         name='pub_open_supply_sowing_idx'),
+            models.Index(fields=['supplies', 'unit_price'], condition=Q(is_sold=False),
+                         name='pub_open_supply_price_idx'),
+            models.Index(fields=['updated_at', 'id'], name='pub_updated_idx'),
+        ]
+
+
+class PublishPicture(models.Model):
+    """
+    A picture of a publication, one row each so adding or removing one doesn't rewrite
+    the publication. `key` is its storage key, `variants` the {size: {extension: url}}
+    of its smaller copies (null for pictures uploaded before them) and `content_hash`
+    the sha256 of the uploaded file (empty for pictures migrated from picture_URLs).
+    Rows with the same `key` share its ImageBlob.
+    """
+    publish = models.ForeignKey(Publish, related_name='pictures', on_delete=models.CASCADE)
+    ordinal = models.PositiveIntegerField(default=0)
+    key = models.CharField(max_length=255)
+    url = models.URLField(max_length=500)
+    variants = models.JSONField(null=True, blank=True)
+    content_hash = models.CharField(max_length=64, blank=True)
+
+    class Meta:
+        verbose_name = 'Foto de cultivo'
+        verbose_name_plural = 'Fotos de cultivos'
+        ordering = ['ordinal', 'id']
+        constraints = [
+            models.UniqueConstraint(fields=['publish', 'key'], name='publish_picture_unique_key'),
+        ]
+        indexes = [
+            models.Index(fields=['publish', 'ordinal', 'id'], name='publish_picture_order_idx'),
+        ]
+
+
+class ImageBlob(models.Model):
+    """
+    Processed publication picture stored under the sha256 of the uploaded file, so the
+    same photo uploaded to several publications is stored once. `refs` counts the
+    PublishPicture rows with its key plus the uploads of it in progress; the objects
+    are deleted when it drops to 0. `stored` is set once they are all in the storage.
+    """
+    key = models.CharField(max_length=255, unique=True)
+    refs = models.PositiveIntegerField(default=0)
+    stored = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Imagen almacenada'
+        verbose_name_plural = 'Imágenes almacenadas'
+
+
+class Tombstone(models.Model):
+    """
+    Deleted publication, order, advertisement or user, so `/sync/` can tell clients to
+    drop it. `user_id` is the owner, used to send advertisement deletions only to them.
+    Old tombstones are removed by `manage.py prune_tombstones`.
+    """
+    model = models.CharField(max_length=20)
+    object_id = models.IntegerField()
+    user_id = models.IntegerField(null=True)
+    deleted_at = models.DateTimeField(default=now)
+
+    class Meta:
+        verbose_name = 'Eliminado'
+        verbose_name_plural = 'Eliminados'
+        indexes = [
+            models.Index(fields=['deleted_at', 'id'], name='tombstone_deleted_idx'),
+        ]
+
+
+class AudienceCell(models.Model):
+    """
+    Number of open publications or orders per supply, geography and sowing/harvest
+    month. EstimatePublic sums cells instead of counting listings. Kept up to date by
+    agricultores.signals, rebuilt from scratch with `manage.py rebuild_audience_cube`.
+    Missing geography is stored as 0.
+    """
+    KINDS = [('pub', 'Cultivo'), ('order', 'Pedido')]
+    COLUMNS = ['kind', 'supply_id', 'department_id', 'region_id', 'district_id', 'sowing_month', 'harvest_month']
+
+    kind = models.CharField(max_length=5, choices=KINDS)
+    supply_id = models.IntegerField()
+    department_id = models.IntegerField(default=0)
+    region_id = models.IntegerField(default=0)
+    district_id = models.IntegerField(default=0)
+    sowing_month = models.DateField()
+    harvest_month = models.DateField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name = 'Celda de audiencia'
+        verbose_name_plural = 'Celdas de audiencia'
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'supply_id', 'department_id', 'region_id', 'district_id',
+                                            'sowing_month', 'harvest_month'], name='audience_cell_unique'),
+        ]
+
+    @staticmethod
+    def to_utc(value):
+        "Datetime, date or ISO string as an aware UTC datetime, the way the date filters read it."
+        value = models.DateTimeField().to_python(value)
+        if timezone.is_naive(value):
+            value = timezone.make_aware(value)
+        return value.astimezone(datetime.timezone.utc)
+
+    @classmethod
+    def get_month(cls, value):
+        value = cls.to_utc(value)
+        return datetime.date(value.year, value.month, 1)
+
+    @classmethod
+    def get_month_bounds(cls, beginning, ending):
+        """
+        First and last month of the inclusive range [beginning, ending] when it covers whole
+        months, None when a bound falls inside a month. Missing bounds stay None.
+        """
+        first = last = None
+        if beginning is not None:
+            beginning = cls.to_utc(beginning)
+            first = cls.get_month(beginning)
+            if beginning != datetime.datetime.combine(first, datetime.time(), datetime.timezone.utc):
+                return None
+        if ending is not None:
+            following = cls.to_utc(ending) + datetime.timedelta(microseconds=1)
+            if following.day != 1 or following.time() != datetime.time():
+                return None
+            last = cls.get_month(following - datetime.timedelta(days=1))
+        return first, last
+
+    @classmethod
+    def count_listings(cls, model, supplies=None, department_id=None, region_id=None, district_id=None,
+                       sowing_months=(None, None), harvest_months=(None, None)):
+        "Open listings of `model` in the given supplies, geography and month ranges."
+        cells = cls.objects.filter(kind=model.audience_kind)
+        if supplies:
+            cells = cells.filter(supply_id__in=supplies)
+        if department_id is not None:
+            cells = cells.filter(department_id=department_id)
+        if region_id is not None:
+            cells = cells.filter(region_id=region_id)
+        if district_id is not None:
+            cells = cells.filter(district_id=district_id)
+        for column, (first, last) in (('sowing_month', sowing_months), ('harvest_month', harvest_months)):
+            if first is not None:
+                cells = cells.filter(**{column + '__gte': first})
+            if last is not None:
+                cells = cells.filter(**{column + '__lte': last})
+        return cells.aggregate(total=models.Sum('count'))['total'] or 0
+
+    @classmethod
+    def apply(cls, deltas):
+        "Add each delta to its cell, creating missing cells, in one statement."
+        deltas = [(key, delta) for key, delta in deltas.items() if key is not None and delta]
+        table = cls._meta.db_table
+        columns = ', '.join(cls.COLUMNS)
+        row = '(%s)' % ', '.join(['%s'] * (len(cls.COLUMNS) + 1))
+        with connection.cursor() as cursor:
+            for start in range(0, len(deltas), 1000):
+                batch = deltas[start:start + 1000]
+                cursor.execute(
+                    'INSERT INTO {table} ({columns}, count) VALUES {rows} '
+                    'ON CONFLICT ({columns}) DO UPDATE SET count = {table}.count + EXCLUDED.count'
+                    .format(table=table, columns=columns, rows=', '.join([row] * len(batch))),
+                    [value for key, delta in batch for value in key + (delta,)])
+
+    @classmethod
+    def move_listings(cls, model, listings, geography):
+        "Move the cells of `listings` to another geography before they're updated in bulk."
+        deltas = Counter()
+        for values in listings.values(*model.get_audience_columns()):
+            deltas[model.get_audience_cell(values)] -= 1
+            deltas[model.get_audience_cell(dict(values, **geography))] += 1
+        cls.apply(deltas)
+
+
+class ReachSketch(models.Model):
+    """
+    HyperLogLog sketch of the owners of the open publications or orders of one supply in
+    one district, to estimate how many distinct users an ad reaches. Sketches only grow:
+    closed, deleted or moved listings still count until `manage.py rebuild_reach_sketches`.
+    Missing geography is stored as 0.
+    """
+    kind = models.CharField(max_length=5, choices=AudienceCell.KINDS)
+    supply_id = models.IntegerField()
+    district_id = models.IntegerField(default=0)
+    region_id = models.IntegerField(default=0)
+    department_id = models.IntegerField(default=0)
+    registers = models.BinaryField(default=sketches.empty)
+
+    class Meta:
+        verbose_name = 'Sketch de alcance'
+        verbose_name_plural = 'Sketches de alcance'
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'supply_id', 'district_id'], name='reach_sketch_unique'),
+        ]
+
+    @classmethod
+    def add_users(cls, kind, supply_id, geography, user_ids):
+        "Add `user_ids` to the sketch of a supply and district, creating it if needed."
+        cell = {'kind': kind, 'supply_id': supply_id, 'district_id': geography['district_id'] or 0}
+        with transaction.atomic():
+            cls.objects.bulk_create([cls(region_id=geography['region_id'] or 0,
+                                         department_id=geography['department_id'] or 0, **cell)],
+                                    ignore_conflicts=True)
+            sketch = cls.objects.select_for_update().only('registers').get(**cell)
+            registers = sketches.add(bytes(sketch.registers), user_ids)
+            if registers != sketch.registers:
+                sketch.registers = registers
+                sketch.save(update_fields=['registers'])
+
+    @classmethod
+    def add_listing(cls, listing):
+        if not getattr(listing, listing.closed_field):
+            geography = {name: getattr(listing, name) for name in ('district_id', 'region_id', 'department_id')}
+            cls.add_users(listing.audience_kind, listing.supplies_id, geography, [listing.user_id])
+
+    @classmethod
+    def move_listings(cls, model, listings, geography):
+        "Add the owners of `listings` to the sketches of the district they are moving to."
+        open_listings = listings.filter(**{model.closed_field: False})
+        for supply_id, user_id in open_listings.values_list('supplies_id', 'user_id').distinct():
+            cls.add_users(model.audience_kind, supply_id, geography, [user_id])
+
+    @classmethod
+    def estimate_reach(cls, kinds, supplies=None, department_id=None, region_id=None, district_id=None):
+        "Approximate number of distinct users with open listings of `kinds` in the given supplies and geography."
+        cells = cls.objects.filter(kind__in=kinds)
+        if supplies:
+            cells = cells.filter(supply_id__in=supplies)
+        if department_id is not None:
+            cells = cells.filter(department_id=department_id)
+        if region_id is not None:
+            cells = cells.filter(region_id=region_id)
+        if district_id is not None:
+            cells = cells.filter(district_id=district_id)
+        registers = [bytes(value) for value in cells.values_list('registers', flat=True)]
+        return sketches.estimate(sketches.merge(registers))
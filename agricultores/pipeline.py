@@ -0,0 +1,354 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urljoin, urlparse
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connections, transaction
+from django.db.models import F, Max
+from django.db.models.functions import Now
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from agricultores import blobs, cache, conditional
+from agricultores.images import encode_files, get_keys, get_variants
+from agricultores.models import Advertisement, ImageBlob, Publish, PublishPicture, User
+from backend.custom_storage import MediaStorage
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineBusy(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Hay demasiadas imágenes en proceso, vuelva a intentarlo en unos segundos.'
+    default_code = 'pipeline_busy'
+
+    def __init__(self, wait):
+        super().__init__()
+        # Sent as Retry-After by the DRF exception handler
+        self.wait = wait
+
+
+def get_url(key):
+    url = MediaStorage().url(key)
+    return urljoin(url, urlparse(url).path)
+
+
+def upload(key, content, content_type):
+    content = ContentFile(content, name=key)
+    content.content_type = content_type
+    MediaStorage().save(key, content)
+
+
+def set_profile_picture(user_id, picture):
+    user = User.objects.filter(id=user_id).first()
+    if user is not None:
+        user.profile_picture_URL = picture.url
+        user.save(update_fields=['profile_picture_URL', 'updated_at'])
+
+
+def add_pub_pictures(pub_id, pictures):
+    """
+    Inserts a PublishPicture row per picture after the existing ones. Pictures the
+    publication already has are left out, which makes uploading the same photo twice,
+    or a retry after a lost response, harmless. Returns the keys left out, whose blob
+    references the pipeline drops.
+    """
+    with transaction.atomic():
+        # Locked so that concurrent uploads to the publication see each other's rows
+        pub = Publish.objects.select_for_update().filter(id=pub_id).values_list('id', flat=True).first()
+        if pub is None:
+            return [picture.key for picture in pictures]
+        keys = set(PublishPicture.objects.filter(publish_id=pub_id).values_list('key', flat=True))
+        added, unused = [], []
+        for picture in pictures:
+            (unused if picture.key in keys else added).append(picture)
+            keys.add(picture.key)
+        if added:
+            last = PublishPicture.objects.filter(publish_id=pub_id).aggregate(last=Max('ordinal'))['last']
+            first = 0 if last is None else last + 1
+            PublishPicture.objects.bulk_create([
+                PublishPicture(publish_id=pub_id, ordinal=first + index, key=picture.key, url=picture.url,
+                               variants=picture.variants, content_hash=picture.content_hash)
+                for index, picture in enumerate(added)
+            ])
+    # After the commit, a request between the bump and it would cache the old pictures
+    if added:
+        touch_pub(pub_id)
+    return [picture.key for picture in unused]
+
+
+def remove_pub_pictures(pub_id, urls):
+    """
+    Deletes the pictures of the publication at `urls`. Returns {url: key} of the rows
+    this call deleted, a concurrent call for the same URLs gets nothing.
+    """
+    with transaction.atomic():
+        rows = list(PublishPicture.objects.select_for_update().filter(publish_id=pub_id, url__in=urls)
+                    .values_list('id', 'url', 'key'))
+        PublishPicture.objects.filter(id__in=[row[0] for row in rows]).delete()
+    if rows:
+        touch_pub(pub_id)
+    return {url: key for id, url, key in rows}
+
+
+def set_pub_pictures(pub_id, urls):
+    """
+    Makes `urls` the pictures of the publication, in that order. The pictures left out
+    are removed and their blobs released. URLs it doesn't have yet must be of stored
+    blobs, which get a reference; those deleted since the request was validated are
+    skipped.
+    """
+    keys = list(dict.fromkeys(get_keys(url)[0] for url in urls))
+    with transaction.atomic():
+        if Publish.objects.select_for_update().filter(id=pub_id).first() is None:
+            return
+        current = {picture.key: picture for picture in PublishPicture.objects.filter(publish_id=pub_id)}
+        added = [key for key in keys if key not in current]
+        # A blob with references can't be dropped while it is locked here
+        shared = set(ImageBlob.objects.select_for_update().filter(key__in=added, stored=True, refs__gt=0)
+                     .order_by('key').values_list('key', flat=True))
+        ImageBlob.objects.filter(key__in=shared).update(refs=F('refs') + 1)
+        keys = [key for key in keys if key in current or key in shared]
+        removed = [key for key in current if key not in keys]
+
+        PublishPicture.objects.filter(id__in=[current[key].id for key in removed]).delete()
+        pictures = []
+        for ordinal, key in enumerate(keys):
+            picture = current.get(key)
+            if picture is None:
+                url = get_url(key)
+                picture = PublishPicture(publish_id=pub_id, key=key, url=url, variants=get_variants(url),
+                                         content_hash=blobs.BLOB_RE.match(key).group('digest'))
+            picture.ordinal = ordinal
+            pictures.append(picture)
+        PublishPicture.objects.bulk_update([picture for picture in pictures if picture.pk], ['ordinal'])
+        PublishPicture.objects.bulk_create([picture for picture in pictures if not picture.pk])
+    if removed:
+        blobs.release(removed)
+    touch_pub(pub_id)
+
+
+def touch_pub(pub_id):
+    """
+    Picture rows are written with bulk_create() and delete(), which send no signal for
+    the publication: this moves its updated_at for /sync/ and does the part of
+    invalidate_listing pictures need.
+    """
+    Publish.objects.filter(id=pub_id).update(updated_at=Now())
+    pub = Publish.objects.filter(id=pub_id).values('user_id', 'supplies_id').first()
+    if pub is not None:
+        cache.bump_versions('pubs', {pub['supplies_id']})
+        conditional.bump('publish', 'publish:user:%s' % pub['user_id'])
+
+
+def add_pub_picture(pub_id, picture):
+    return add_pub_pictures(pub_id, [picture])
+
+
+def set_ad_picture(ad_id, picture):
+    ad = Advertisement.objects.filter(id=ad_id).first()
+    if ad is not None:
+        ad.picture_URL = picture.url
+        ad.save(update_fields=['picture_URL', 'updated_at'])
+
+
+# What apply() receives once a picture is uploaded
+Picture = namedtuple('Picture', ['key', 'url', 'variants', 'content_hash'])
+
+
+class Job:
+    def __init__(self, raw, key, url, apply, args, options, on_failure=None):
+        self.raw = raw
+        self.key = key
+        self.url = url
+        self.apply = apply
+        self.args = args
+        self.options = options
+        self.on_failure = on_failure
+
+
+class Group:
+    """
+    Pictures processed concurrently and applied together, with a single
+    apply(*args, pictures) once the last one is uploaded. Failed pictures are left out.
+    """
+
+    def __init__(self, count, apply, args):
+        self.lock = threading.Lock()
+        self.pictures = [None] * count
+        self.done = set()
+        self.applied = False
+        self.apply = apply
+        self.args = args
+
+    def collect(self, index, picture):
+        with self.lock:
+            self.done.add(index)
+            self.pictures[index] = picture
+            # Called again by the retries of the last job until apply() succeeds
+            if len(self.done) == len(self.pictures) and not self.applied:
+                pictures = [picture for picture in self.pictures if picture is not None]
+                unused = self.apply(*self.args, pictures) if pictures else None
+                self.applied = True
+                return unused
+
+
+class Slot:
+    """
+    Places in the pipeline queue, taken before the request creates anything so that a
+    full queue is answered with 503 instead of leaving rows without their picture.
+    Leaving the `with` block gives back the places submit() didn't use.
+    """
+
+    def __init__(self, pipeline, semaphore, count=1):
+        self.pipeline = pipeline
+        self.semaphore = semaphore
+        self.available = count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        for _ in range(self.available):
+            self.semaphore.release()
+        self.available = 0
+
+    def submit(self, raw, key, apply, *args, **options):
+        """
+        Encodes `raw` with encode_files(**options), uploads the JPEG to `key` (and its
+        variants next to it) and then calls apply(*args, picture) with a Picture.
+        Returns the URL the picture will have.
+
+        Keys from blobs.get_key() are shared: nothing is encoded or uploaded when the
+        blob is already stored, and apply() returns the keys it didn't use so their
+        references are dropped.
+        """
+        return self.enqueue(Job(raw, key, get_url(key), apply, args, options))
+
+    def submit_group(self, raws, keys, apply, *args, **options):
+        """
+        submit() for several pictures at once, they are processed concurrently and then
+        apply(*args, pictures) is called once. Returns the URLs in the order of `raws`.
+        """
+        group = Group(len(raws), apply, args)
+        return [
+            self.enqueue(Job(raw, key, get_url(key), group.collect, (index,), options,
+                             on_failure=partial(group.collect, index, None)))
+            for index, (raw, key) in enumerate(zip(raws, keys))
+        ]
+
+    def enqueue(self, job):
+        assert self.available > 0, 'No place left in this slot.'
+        self.available -= 1
+        if self.pipeline.options['EAGER']:
+            try:
+                self.pipeline.work(job)
+            finally:
+                self.semaphore.release()
+        else:
+            # After the commit, the worker must see the rows the request created
+            transaction.on_commit(lambda: self.pipeline.enqueue(job, self.semaphore))
+        return job.url
+
+
+class ImagePipeline:
+    """
+    Decodes, re-encodes and uploads pictures on a small per-process thread pool so the
+    upload views answer as soon as the raw file is received.
+
+    At most WORKERS jobs run and QUEUE_SIZE more wait; past that reserve() raises
+    PipelineBusy. The pool is created on first use and again after a fork, since
+    gunicorn --preload forks the workers from a process whose threads don't survive.
+    Uploads and database updates are retried with exponential backoff.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.executor = None
+        self.semaphore = None
+
+    @property
+    def options(self):
+        return settings.IMAGE_PIPELINE
+
+    def get_executor(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.executor = ThreadPoolExecutor(max_workers=self.options['WORKERS'],
+                                                   thread_name_prefix='image-pipeline')
+                self.semaphore = threading.BoundedSemaphore(self.options['WORKERS'] + self.options['QUEUE_SIZE'])
+                self.pid = os.getpid()
+            return self.executor
+
+    def reserve(self, count=1):
+        self.get_executor()
+        slot = Slot(self, self.semaphore, 0)
+        for _ in range(count):
+            if not self.semaphore.acquire(blocking=False):
+                slot.__exit__(None, None, None)
+                raise PipelineBusy(self.options['RETRY_AFTER'])
+            slot.available += 1
+        return slot
+
+    def enqueue(self, job, semaphore):
+        future = self.get_executor().submit(self.work, job)
+        future.add_done_callback(lambda future: semaphore.release())
+
+    def work(self, job):
+        try:
+            self.run(job)
+        except Exception:
+            logger.exception('Image pipeline job for %s failed', job.key)
+            if job.on_failure is not None:
+                self.release_unused(self.retry(job.on_failure))
+        finally:
+            # Each worker thread has its own connections, they would stay open otherwise
+            if not self.options['EAGER']:
+                connections.close_all()
+
+    def run(self, job):
+        raw = job.raw
+        shared = blobs.is_shared(job.key)
+        stored = shared and self.retry(blobs.acquire, job.key)
+        try:
+            if not stored:
+                for name, (content, content_type) in encode_files(raw, job.key, **job.options).items():
+                    self.retry(upload, name, content, content_type)
+                if shared:
+                    self.retry(blobs.mark_stored, job.key)
+            variants = get_variants(job.url) if job.options.get('variants') else None
+            picture = Picture(job.key, job.url, variants, hashlib.sha256(raw).hexdigest())
+            unused = self.retry(job.apply, *job.args, picture)
+        except Exception:
+            if shared:
+                self.retry(blobs.release, [job.key])
+            raise
+        self.release_unused(unused)
+
+    def release_unused(self, keys):
+        keys = [key for key in keys or [] if blobs.is_shared(key)]
+        if keys:
+            self.retry(blobs.release, keys)
+
+    def retry(self, function, *args):
+        attempts = self.options['RETRIES'] + 1
+        for attempt in range(attempts):
+            try:
+                return function(*args)
+            except Exception:
+                if attempt == attempts - 1:
+                    raise
+                logger.warning('Image pipeline step %s failed, retrying', getattr(function, '__name__', function),
+                               exc_info=True)
+                time.sleep(self.options['RETRY_DELAY'] * 2 ** attempt)
+
+
+pipeline = ImagePipeline()
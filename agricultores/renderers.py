@@ -0,0 +1,128 @@
+from collections import Counter
+
+import msgpack
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+# A nested object sent once in the `refs` table, its payload is the packed index
+REF_EXT_TYPE = 1
+
+
+def freeze(value):
+    "Hashable equivalent of a JSON-like value, raises TypeError when there is none."
+    if isinstance(value, dict):
+        return 'd', tuple((freeze(key), freeze(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return 'l', tuple(freeze(item) for item in value)
+    hash(value)
+    # Tagged with the type, 1, 1.0 and True are equal but must not share a ref
+    return type(value).__name__, value
+
+
+def get_key(value):
+    try:
+        return freeze(value)
+    except TypeError:
+        return None
+
+
+class Ref:
+    __slots__ = ('index',)
+
+    def __init__(self, index):
+        self.index = index
+
+
+class MessagePackRenderer(BaseRenderer):
+    """
+    MessagePack responses, picked with `Accept: application/msgpack`.
+
+    Nested objects that appear more than once in a response (the supply of each
+    publication, the district of each advertisement...) are sent once: the body is
+    {"refs": [...], "data": ...} and each occurrence is an ext type REF_EXT_TYPE whose
+    payload is the packed index in `refs`. MessagePackParser undoes it.
+    """
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        keys, counts = {}, Counter()
+        self.count_nested(data, keys, counts, nested=False)
+        refs = {key: None for key, count in counts.items() if count > 1}
+        table = []
+        encoded = self.encode(data, keys, refs, table)
+        return msgpack.packb({'refs': table, 'data': encoded}, use_bin_type=True, default=self.default)
+
+    def count_nested(self, value, keys, counts, nested):
+        "Count the nested objects by content, remembering the key of each one by id()."
+        if isinstance(value, dict):
+            if nested:
+                key = keys[id(value)] = get_key(value)
+                if key is not None:
+                    counts[key] += 1
+                    if counts[key] > 1:
+                        return
+            for item in value.values():
+                if isinstance(item, (dict, list, tuple)):
+                    self.count_nested(item, keys, counts, nested=True)
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                if isinstance(item, (dict, list, tuple)):
+                    self.count_nested(item, keys, counts, nested)
+
+    def encode(self, value, keys, refs, table):
+        if isinstance(value, dict):
+            key = keys.get(id(value))
+            if key in refs:
+                if refs[key] is None:
+                    encoded = {name: self.encode(item, keys, refs, table) for name, item in value.items()}
+                    refs[key] = msgpack.ExtType(REF_EXT_TYPE, msgpack.packb(len(table)))
+                    table.append(encoded)
+                return refs[key]
+            return {name: self.encode(item, keys, refs, table) for name, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self.encode(item, keys, refs, table) for item in value]
+        return value
+
+    def default(self, value):
+        # Dates, decimals, lazy strings... the same conversions as the JSON renderer
+        return JSONEncoder().default(value)
+
+
+class MessagePackParser(BaseParser):
+    media_type = 'application/msgpack'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            data = msgpack.unpackb(stream.read(), raw=False, ext_hook=self.ext_hook)
+        except (ValueError, msgpack.ExtraData, msgpack.FormatError, msgpack.StackError) as exc:
+            raise ParseError('MessagePack inválido: %s' % exc)
+        if isinstance(data, dict) and set(data) == {'refs', 'data'} and isinstance(data['refs'], list):
+            # A reference can only point to an earlier entry, which rules out cycles
+            refs = []
+            for value in data['refs']:
+                refs.append(self.resolve(value, refs))
+            return self.resolve(data['data'], refs)
+        return data
+
+    def ext_hook(self, code, payload):
+        if code == REF_EXT_TYPE:
+            return Ref(msgpack.unpackb(payload))
+        return msgpack.ExtType(code, payload)
+
+    def resolve(self, value, refs):
+        if isinstance(value, Ref):
+            if not isinstance(value.index, int) or not 0 <= value.index < len(refs):
+                raise ParseError('Referencia MessagePack inválida.')
+            return refs[value.index]
+        if isinstance(value, dict):
+            return {key: self.resolve(item, refs) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.resolve(item, refs) for item in value]
+        return value
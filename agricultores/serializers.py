@@ -1,8 +1,13 @@
+from django.core.exceptions import FieldDoesNotExist
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
 from rest_framework.fields import CharField
 
-from agricultores.models import Department, District, Region, Supply, Advertisement, LinkedTo, Publish, Order
+from agricultores import blobs
+from agricultores.images import get_keys
+from agricultores.models import Department, District, Region, Supply, Advertisement, LinkedTo, Publish, Order, \
+    ImageBlob
+from agricultores.pipeline import set_pub_pictures
 
 
 class RelatedFieldAlternative(serializers.PrimaryKeyRelatedField):
@@ -18,32 +23,142 @@ class RelatedFieldAlternative(serializers.PrimaryKeyRelatedField):
 
     def to_representation(self, instance):
         if self.serializer:
-            return self.serializer(instance, context=self.context).data
+            kwargs = {}
+            if issubclass(self.serializer, DynamicFieldsMixin):
+                kwargs['field_trees'] = getattr(self, 'field_trees', (None, None))
+            return self.serializer(instance, context=self.context, **kwargs).data
         return super().to_representation(instance)
 
 
-class RegionSerializer(serializers.ModelSerializer):
+def parse_field_tree(value):
+    "'id,district.name' -> {'id': {}, 'district': {'name': {}}}"
+    tree = {}
+    for path in value.split(','):
+        node = tree
+        for name in path.strip().split('.'):
+            if name:
+                node = node.setdefault(name, {})
+    return tree
+
+
+def get_field_trees(request):
+    """
+    (fields, expand) trees of a GET request. None means the parameter is absent: all
+    fields, and every nested object embedded as before.
+    """
+    if request is None or request.method not in ('GET', 'HEAD'):
+        return None, None
+    fields = request.query_params.get('fields')
+    expand = request.query_params.get('expand')
+    return parse_field_tree(fields) if fields else None, parse_field_tree(expand) if expand is not None else None
+
+
+def prune_fields(serializer, fields, expand):
+    "Drop the fields not asked for and turn the nested objects not expanded into their id."
+    if fields:
+        for name in list(serializer.fields):
+            if name not in fields:
+                serializer.fields.pop(name)
+    for name, field in list(serializer.fields.items()):
+        nested_fields = (fields or {}).get(name) or None
+        nested_expand = expand.get(name) if expand is not None else None
+        if isinstance(field, serializers.BaseSerializer):
+            if expand is not None and name not in expand:
+                source = {'source': field.source} if field.source != name else {}
+                serializer.fields[name] = serializers.PrimaryKeyRelatedField(read_only=True, **source)
+            else:
+                prune_fields(field, nested_fields, nested_expand)
+        elif isinstance(field, RelatedFieldAlternative) and field.serializer:
+            if expand is not None and name not in expand:
+                field.serializer = None
+            else:
+                field.field_trees = (nested_fields, nested_expand)
+
+
+def get_query_plan(serializer, prefix=''):
+    """
+    select_related paths and only() columns needed to render `serializer` once pruned.
+    The columns are None when some field reads something that isn't a plain model field.
+    """
+    model = serializer.Meta.model
+    method_field_sources = getattr(serializer.Meta, 'method_field_sources', {})
+    select_related, only = [], []
+    for name, field in serializer.fields.items():
+        if field.write_only:
+            continue
+        nested = None
+        if isinstance(field, serializers.BaseSerializer):
+            nested = field
+        elif isinstance(field, RelatedFieldAlternative) and field.serializer:
+            nested = field.serializer(field_trees=getattr(field, 'field_trees', (None, None)))
+
+        if nested is not None:
+            nested_select, nested_only = get_query_plan(nested, prefix + field.source + '__')
+            select_related += [prefix + field.source] + nested_select
+            only = None if only is None or nested_only is None else only + [prefix + field.source] + nested_only
+        elif isinstance(field, serializers.SerializerMethodField) or name in method_field_sources:
+            if name not in method_field_sources:
+                only = None
+                continue
+            for lookup in method_field_sources[name]:
+                path = lookup.split('__')
+                select_related += [prefix + '__'.join(path[:end]) for end in range(1, len(path))]
+                if only is not None:
+                    only.append(prefix + lookup)
+        elif only is not None:
+            try:
+                model._meta.get_field(field.source)
+                only.append(prefix + field.source)
+            except FieldDoesNotExist:
+                only = None
+    return select_related, only
+
+
+class DynamicFieldsMixin:
+    """
+    Sparse fieldsets for GET requests:
+
+    - `?fields=id,name,district.name` keeps only those fields, dotted names reach into
+      nested objects.
+    - `?expand=district,district.region` embeds only those nested objects, the others
+      are rendered as their id. Without `expand` everything stays embedded.
+
+    Nested serializers are pruned by the root one, which reads the request from its
+    context, or takes `field_trees=(fields, expand)` explicitly.
+    """
+
+    def __init__(self, *args, **kwargs):
+        field_trees = kwargs.pop('field_trees', None)
+        super().__init__(*args, **kwargs)
+        if field_trees is None:
+            field_trees = get_field_trees(self.context.get('request'))
+        if field_trees != (None, None):
+            prune_fields(self, *field_trees)
+
+
+class RegionSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Region
         fields = ['id', 'name']
 
 
-class DepartmentSerializer(serializers.ModelSerializer):
+class DepartmentSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Department
         fields = ['id', 'name']
 
 
-class DistrictSerializer(serializers.ModelSerializer):
+class DistrictSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     region = RegionSerializer()
     department = DepartmentSerializer()
 
     class Meta:
         model = District
         fields = '__all__'
+        select_related = ['region', 'department']
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     district = serializers.SerializerMethodField()
     password = serializers.CharField(write_only=True)
 
@@ -69,6 +184,8 @@ class UserSerializer(serializers.ModelSerializer):
         extra_kwargs = {
             'number_of_credits': {'read_only': True}
         }
+        select_related = ['district__region', 'district__department']
+        method_field_sources = {'district': ['district__name', 'district__region__name', 'district__department__name']}
 
     def create(self, validated_data):
         user = get_user_model().objects.create(
@@ -88,50 +205,102 @@ class UserSerializer(serializers.ModelSerializer):
         return obj.district.name + ', ' + obj.district.region.name + ' (' + obj.district.department.name + ')'
 
 
-class SuppliesSerializer(serializers.ModelSerializer):
+class SuppliesSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Supply
         fields = '__all__'
 
 
-class AdvertisementSerializer(serializers.ModelSerializer):
+class AdvertisementSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     region = RegionSerializer()
     department = DepartmentSerializer()
     district = DistrictSerializer()
     class Meta:
         model = Advertisement
-        fields = '__all__'
+        exclude = ['updated_at']
+        select_related = ['region', 'department', 'district__region', 'district__department']
 
 
-class AdressedToSerializer(serializers.ModelSerializer):
+class AdressedToSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     advertisement = AdvertisementSerializer()
     supply = SuppliesSerializer()
     class Meta:
         model = LinkedTo
         fields = '__all__'
+        select_related = ['supply', 'advertisement__region', 'advertisement__department',
+                          'advertisement__district__region', 'advertisement__district__department']
+
+
+class PictureURLsField(serializers.ListField):
+    "URLs of the pictures of a publication, in order."
+    child = serializers.CharField()
 
+    def get_attribute(self, instance):
+        return instance
 
-class PublishSerializer(serializers.ModelSerializer):
+    def to_representation(self, pub):
+        return [picture.url for picture in pub.pictures.all()]
+
+
+class PublishSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     user = serializers.PrimaryKeyRelatedField(read_only=True)
     supplies = RelatedFieldAlternative(queryset=Supply.objects.all(), serializer=SuppliesSerializer)
     user_phone_number = serializers.SerializerMethodField()
+    # Writing it reorders or removes pictures; new ones are uploaded with uploadPubPicture or
+    # /uploads/, or taken from the pictures already stored (e.g. those of another publication)
+    picture_URLs = PictureURLsField(required=False)
+    picture_variants = serializers.SerializerMethodField()
 
     class Meta:
         model = Publish
-        fields = '__all__'
+        exclude = ['district', 'region', 'department', 'updated_at']
+        select_related = ['user', 'supplies']
+        prefetch_related = ['pictures']
+        # The pictures come from the prefetch, they need no column of the publication
+        method_field_sources = {'user_phone_number': ['user__phone_number'], 'picture_URLs': [],
+                                'picture_variants': []}
 
     def get_user_phone_number(self, obj):
         return obj.user.phone_number.as_e164
 
+    def get_picture_variants(self, obj):
+        return [picture.variants for picture in obj.pictures.all()]
 
-class OrderSerializer(serializers.ModelSerializer):
+    def validate_picture_URLs(self, value):
+        keys = {url: get_keys(url)[0] for url in value}
+        known = set(self.instance.pictures.values_list('key', flat=True)) if self.instance is not None else set()
+        known.update(ImageBlob.objects.filter(key__in=[key for key in keys.values() if blobs.is_shared(key)],
+                                              stored=True).values_list('key', flat=True))
+        unknown = [url for url, key in keys.items() if key not in known]
+        if unknown:
+            raise serializers.ValidationError('Imágenes desconocidas: %s' % ', '.join(unknown))
+        return value
+
+    def create(self, validated_data):
+        urls = validated_data.pop('picture_URLs', None)
+        pub = super().create(validated_data)
+        if urls is not None:
+            set_pub_pictures(pub.id, urls)
+        return pub
+
+    def update(self, instance, validated_data):
+        urls = validated_data.pop('picture_URLs', None)
+        pub = super().update(instance, validated_data)
+        if urls is not None:
+            set_pub_pictures(pub.id, urls)
+        return pub
+
+
+class OrderSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     user = serializers.PrimaryKeyRelatedField(read_only=True)
     supplies = RelatedFieldAlternative(queryset=Supply.objects.all(), serializer=SuppliesSerializer)
     user_phone_number = serializers.SerializerMethodField()
 
     class Meta:
         model = Order
-        fields = '__all__'
+        exclude = ['district', 'region', 'department', 'updated_at']
+        select_related = ['user', 'supplies']
+        method_field_sources = {'user_phone_number': ['user__phone_number']}
 
     def get_user_phone_number(self, obj):
         return obj.user.phone_number.as_e164
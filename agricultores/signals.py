@@ -0,0 +1,133 @@
+from collections import Counter
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from agricultores import blobs, cache, conditional
+from agricultores.ads import ad_index
+from agricultores.geography import geography
+from agricultores.models import Advertisement, AudienceCell, Department, District, LinkedTo, Order, Publish, \
+    PublishPicture, ReachSketch, Region, Supply, Tombstone, User
+
+CACHE_NAMESPACES = {Publish: 'pubs', Order: 'orders'}
+RESOURCES = {Publish: 'publish', Order: 'order'}
+
+
+@receiver(pre_save, sender=Publish)
+@receiver(pre_save, sender=Order)
+def remember_previous_state(sender, instance, **kwargs):
+    instance._previous_audience_values = None
+    if instance.pk is not None:
+        instance._previous_audience_values = sender.objects.filter(pk=instance.pk) \
+            .values(*sender.get_audience_columns()).first()
+    instance._previous_supplies_id = (instance._previous_audience_values or {}).get('supplies_id')
+
+
+@receiver(post_save, sender=Publish)
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Publish)
+@receiver(post_delete, sender=Order)
+def invalidate_listing(sender, instance, **kwargs):
+    supply_ids = {instance.supplies_id, getattr(instance, '_previous_supplies_id', None)} - {None}
+    cache.bump_versions(CACHE_NAMESPACES[sender], supply_ids)
+    conditional.bump(RESOURCES[sender], '%s:user:%s' % (RESOURCES[sender], instance.user_id))
+
+
+@receiver(post_save, sender=Publish)
+@receiver(post_save, sender=Order)
+def update_audience_cube(sender, instance, **kwargs):
+    deltas = Counter()
+    previous = getattr(instance, '_previous_audience_values', None)
+    if previous is not None:
+        deltas[sender.get_audience_cell(previous)] -= 1
+    deltas[sender.get_audience_cell(instance.get_audience_values())] += 1
+    AudienceCell.apply(deltas)
+
+
+@receiver(post_save, sender=Publish)
+@receiver(post_save, sender=Order)
+def update_reach_sketch(sender, instance, **kwargs):
+    ReachSketch.add_listing(instance)
+
+
+@receiver(post_delete, sender=Publish)
+@receiver(post_delete, sender=Order)
+def remove_from_audience_cube(sender, instance, **kwargs):
+    AudienceCell.apply({sender.get_audience_cell(instance.get_audience_values()): -1})
+
+
+@receiver(pre_save, sender=User)
+def remember_previous_district(sender, instance, update_fields=None, **kwargs):
+    instance._district_changed = False
+    if instance.pk is None or (update_fields is not None and 'district' not in update_fields):
+        return
+    previous = sender.objects.filter(pk=instance.pk).values_list('district_id', flat=True).first()
+    instance._district_changed = previous != instance.district_id
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def bump_user(sender, instance, **kwargs):
+    conditional.bump('user', 'user:%s' % instance.pk)
+
+
+@receiver(post_save, sender=Supply)
+@receiver(post_delete, sender=Supply)
+def bump_supply(sender, instance, **kwargs):
+    conditional.bump('supply')
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_listings(sender, instance, **kwargs):
+    if not getattr(instance, '_district_changed', False):
+        return
+    for model, namespace in CACHE_NAMESPACES.items():
+        supply_ids = model.objects.filter(user=instance).values_list('supplies_id', flat=True).distinct()
+        cache.bump_versions(namespace, supply_ids)
+
+
+@receiver(post_save, sender=Advertisement)
+@receiver(post_delete, sender=Advertisement)
+def refresh_ad_index(sender, instance, **kwargs):
+    ad_index.refresh(instance.id)
+    conditional.bump('advertisement', 'advertisement:user:%s' % instance.user_id)
+
+
+@receiver(post_save, sender=LinkedTo)
+@receiver(post_delete, sender=LinkedTo)
+def refresh_ad_index_links(sender, instance, **kwargs):
+    ad_index.refresh(instance.advertisement_id)
+    conditional.bump('linkedto')
+
+
+@receiver(post_save, sender=Department)
+@receiver(post_save, sender=Region)
+@receiver(post_save, sender=District)
+@receiver(post_delete, sender=Department)
+@receiver(post_delete, sender=Region)
+@receiver(post_delete, sender=District)
+def invalidate_geography(sender, instance, **kwargs):
+    geography.invalidate()
+    conditional.bump('geography')
+
+
+@receiver(post_delete, sender=PublishPicture)
+def release_picture(sender, instance, **kwargs):
+    # remove_pub_pictures() callers release what they remove, this is for the rows deleted
+    # along with their publication (or its user), which would keep their blobs forever
+    def release():
+        if not Publish.objects.filter(id=instance.publish_id).exists():
+            blobs.release([instance.key])
+
+    if blobs.is_shared(instance.key):
+        transaction.on_commit(release)
+
+
+@receiver(post_delete, sender=Publish)
+@receiver(post_delete, sender=Order)
+@receiver(post_delete, sender=Advertisement)
+@receiver(post_delete, sender=User)
+def create_tombstone(sender, instance, **kwargs):
+    Tombstone.objects.create(model=sender._meta.model_name, object_id=instance.pk,
+                             user_id=getattr(instance, 'user_id', instance.pk))
@@ -0,0 +1,82 @@
+import itertools
+
+from django.conf import settings
+from django.db.models import prefetch_related_objects
+from django.http import StreamingHttpResponse
+from rest_framework.utils.encoders import JSONEncoder
+
+from agricultores.serializers import get_field_trees
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    def dumps(data):
+        return orjson.dumps(data, default=JSONEncoder().default)
+else:
+    import json
+
+    def dumps(data):
+        return json.dumps(data, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class StreamingListMixin:
+    """
+    Streams `list` as a JSON array instead of building the whole list and its JSON in
+    memory. Rows are read with QuerySet.iterator() and encoded STREAMING_CHUNK_SIZE at a
+    time, so memory stays flat whatever the number of rows.
+
+    Views with `stream_always` stream every unpaginated list, the others only with
+    `?stream=1` (which also turns pagination off). Rows go through `fast_serializer_class`
+    when the view has one, otherwise through `serializer_class` one chunk at a time.
+    """
+    stream_always = False
+    stream_query_param = 'stream'
+
+    def should_stream(self, request):
+        if request.accepted_renderer.format != 'json':
+            return False
+        if request.query_params.get(self.stream_query_param, '').lower() in ('1', 'true'):
+            return True
+        return self.stream_always and self.paginator is None
+
+    def list(self, request, *args, **kwargs):
+        if not self.should_stream(request):
+            return super().list(request, *args, **kwargs)
+
+        queryset = self.filter_queryset(self.get_queryset())
+        chunk_size = settings.STREAMING_CHUNK_SIZE
+        fast_serializer_class = getattr(self, 'fast_serializer_class', None)
+        if fast_serializer_class is not None:
+            fast_serializer = fast_serializer_class(*get_field_trees(request))
+            fast_serializer.chunk_size = chunk_size
+            items = fast_serializer.iter_serialize(fast_serializer.values(queryset).iterator(chunk_size=chunk_size))
+        else:
+            items = self.iter_serialize(queryset, chunk_size)
+
+        return StreamingHttpResponse(self.iter_json(items, chunk_size), content_type='application/json')
+
+    def iter_serialize(self, queryset, chunk_size):
+        prefetch_related = queryset._prefetch_related_lookups
+        rows = queryset.iterator(chunk_size=chunk_size)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                return
+            # iterator() skips prefetch_related, so it is done per chunk instead
+            if prefetch_related:
+                prefetch_related_objects(chunk, *prefetch_related)
+            yield from self.get_serializer(chunk, many=True).data
+
+    def iter_json(self, items, chunk_size):
+        yield b'['
+        separator = b''
+        while True:
+            chunk = [dumps(item) for item in itertools.islice(items, chunk_size)]
+            if not chunk:
+                break
+            yield separator + b','.join(chunk)
+            separator = b','
+        yield b']'
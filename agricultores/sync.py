@@ -0,0 +1,145 @@
+import base64
+import datetime
+import json
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException, NotFound
+
+from agricultores.fast_serializers import OrderFastSerializer, PublishFastSerializer
+from agricultores.models import Advertisement, Order, Publish, Tombstone, User
+from agricultores.pagination import CursorEncoder
+from agricultores.serializers import AdvertisementSerializer, UserSerializer
+
+TOMBSTONES = 'tombstone'
+
+
+class SyncExpired(APIException):
+    status_code = status.HTTP_410_GONE
+    default_detail = 'El token de sincronización expiró, vuelva a descargar todo.'
+    default_code = 'sync_expired'
+
+
+def after(position, date_field):
+    "Rows whose (date, id) key comes after `position`."
+    date, id_ = position
+    return Q(**{date_field + '__gt': date}) | Q(**{date_field: date, 'id__gt': id_})
+
+
+class Resource:
+    """
+    One synced model, read in (updated_at, id) order. Publications and orders go through
+    their fast serializer, the rest through their ModelSerializer. `own` limits the rows
+    to those of the requesting user.
+    """
+
+    def __init__(self, model, serializer_class=None, fast_serializer_class=None, own=False):
+        self.model = model
+        self.name = model._meta.model_name
+        self.serializer_class = serializer_class
+        self.fast_serializer_class = fast_serializer_class
+        self.own = own
+
+    def get_queryset(self, user):
+        queryset = self.model.objects.all()
+        if self.own:
+            queryset = queryset.filter(user=user)
+        if self.fast_serializer_class is not None:
+            return queryset.values(*self.fast_serializer_class().columns, 'updated_at')
+        meta = self.serializer_class.Meta
+        return queryset.select_related(*getattr(meta, 'select_related', ()))
+
+    def get_position(self, row):
+        if isinstance(row, dict):
+            return [row['updated_at'], row['id']]
+        return [row.updated_at, row.id]
+
+    def serialize(self, rows):
+        if self.fast_serializer_class is not None:
+            return self.fast_serializer_class().serialize(rows)
+        return self.serializer_class(rows, many=True).data
+
+
+RESOURCES = [
+    Resource(Publish, fast_serializer_class=PublishFastSerializer),
+    Resource(Order, fast_serializer_class=OrderFastSerializer),
+    Resource(Advertisement, serializer_class=AdvertisementSerializer, own=True),
+    Resource(User, serializer_class=UserSerializer),
+]
+
+
+def encode_token(token):
+    payload = json.dumps(token, cls=CursorEncoder, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_token(encoded):
+    field = Publish._meta.get_field('updated_at')
+    try:
+        token = json.loads(base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4)).decode('utf-8'))
+        if not isinstance(token, dict):
+            raise ValueError
+        decoded = {'at': field.to_python(token['at'])}
+        for name in [resource.name for resource in RESOURCES] + [TOMBSTONES]:
+            if token.get(name) is not None:
+                date, id_ = token[name]
+                decoded[name] = [field.to_python(date), int(id_)]
+        return decoded
+    except (KeyError, TypeError, ValueError, UnicodeDecodeError, ValidationError):
+        raise NotFound('Token de sincronización inválido.')
+
+
+def get_changes(user, since=None, page_size=None):
+    """
+    Rows created, changed or deleted after the `since` token, at most `page_size` of each
+    kind. Clients call again with `next` while `has_more` is true, then keep `next` for
+    the following sync. Without a token every row is returned.
+    """
+    options = settings.SYNC
+    size = page_size or options['PAGE_SIZE']
+    now = timezone.now()
+    upper = now - datetime.timedelta(seconds=options['LAG_SECONDS'])
+
+    if since:
+        token = decode_token(since)
+        if token['at'] < now - datetime.timedelta(days=options['TOMBSTONE_DAYS']):
+            raise SyncExpired()
+    else:
+        # A first sync has nothing to delete, only later deletions matter
+        token = {TOMBSTONES: [upper, 0]}
+    token['at'] = upper
+
+    data = OrderedDict()
+    has_more = False
+    for resource in RESOURCES:
+        queryset = resource.get_queryset(user).filter(updated_at__lte=upper).order_by('updated_at', 'id')
+        if token.get(resource.name) is not None:
+            queryset = queryset.filter(after(token[resource.name], 'updated_at'))
+        rows = list(queryset[:size + 1])
+        has_more |= len(rows) > size
+        rows = rows[:size]
+        if rows:
+            token[resource.name] = resource.get_position(rows[-1])
+        data[resource.name] = resource.serialize(rows)
+
+    tombstones = Tombstone.objects.filter(deleted_at__lte=upper) \
+        .filter(Q(model__in=[resource.name for resource in RESOURCES if not resource.own]) |
+                Q(model__in=[resource.name for resource in RESOURCES if resource.own], user_id=user.id)) \
+        .filter(after(token[TOMBSTONES], 'deleted_at')) \
+        .order_by('deleted_at', 'id').values_list('model', 'object_id', 'deleted_at', 'id')
+    tombstones = list(tombstones[:size + 1])
+    has_more |= len(tombstones) > size
+    tombstones = tombstones[:size]
+    if tombstones:
+        token[TOMBSTONES] = list(tombstones[-1][2:])
+    data['deleted'] = OrderedDict((resource.name, []) for resource in RESOURCES)
+    for model, object_id, deleted_at, id_ in tombstones:
+        data['deleted'][model].append(object_id)
+
+    data['next'] = encode_token(token)
+    data['has_more'] = has_more
+    return data
@@ -1,3 +1,327 @@
-from django.test import TestCase
+import base64
+import datetime
+import json
+from io import BytesIO
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+
+from agricultores import blobs, pipeline
+from agricultores.images import get_keys
+from agricultores.models import Department, Region, District, Supply, User, Publish, PublishPicture, Order, ImageBlob
+from agricultores.pagination import KeysetPagination
+from backend.custom_storage import MediaStorage
+
+
+class ListQueryCountTests(TestCase):
+    """
+    List endpoints must issue the same number of queries whatever the number of rows,
+    i.e. nested objects come from select_related/prefetch_related and not one query per row.
+    """
+
+    def setUp(self):
+        cache.clear()
+        department = Department.objects.create(name='Lima')
+        region = Region.objects.create(name='Lima', department=department)
+        self.district = District.objects.create(name='Miraflores', region=region, department=department)
+        self.supply = Supply.objects.create(name='Papa')
+        self.client = APIClient()
+        self.client.force_authenticate(self.create_user(0))
+
+    def create_user(self, number):
+        return User.objects.create(phone_number='+519990%05d' % number, district=self.district, role='ag')
+
+    def create_rows(self, count):
+        start = User.objects.count()
+        for number in range(start, start + count):
+            user = self.create_user(number)
+            pub = Publish.objects.create(user=user, supplies=self.supply, weight_unit='kg', unit_price=1,
+                                         area_unit='m2', area=1, harvest_date=timezone.now(),
+                                         sowing_date=timezone.now())
+            PublishPicture.objects.create(publish=pub, key='pub_pictures/%d' % number,
+                                          url='https://cosecha-app.s3.amazonaws.com/pub_pictures/%d' % number)
+            Order.objects.create(user=user, supplies=self.supply, weight_unit='kg', unit_price=1, area_unit='m2',
+                                 area=1, desired_harvest_date=timezone.now(), desired_sowing_date=timezone.now())
+
+    def count_queries(self, url):
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def assertConstantQueries(self, url):
+        self.create_rows(2)
+        few = self.count_queries(url)
+        self.create_rows(8)
+        many = self.count_queries(url)
+        self.assertEqual(few, many)
+
+    def test_users(self):
+        self.assertConstantQueries('/users/')
+
+    def test_agricultores_filter(self):
+        self.assertConstantQueries('/api/filter/agricultores/')
+
+    def test_compradores_filter(self):
+        self.assertConstantQueries('/api/filter/compradores/?department=%d' % self.district.department_id)
+
+    def test_publish_filter(self):
+        self.assertConstantQueries('/api/filter/pubs/')
+
+    def test_order_filter(self):
+        self.assertConstantQueries('/api/filter/orders/')
+
+    def test_publish_list(self):
+        self.assertConstantQueries('/publish/')
+
+    def test_order_list(self):
+        self.assertConstantQueries('/order/')
+
+
+class KeysetPaginationTests(TestCase):
+    "Walking /api/filter/pubs/ page by page must return every row once, ties included."
+
+    def setUp(self):
+        cache.clear()
+        department = Department.objects.create(name='Lima')
+        region = Region.objects.create(name='Lima', department=department)
+        self.district = District.objects.create(name='Miraflores', region=region, department=department)
+        self.supply = Supply.objects.create(name='Papa')
+        self.user = User.objects.create(phone_number='+51999000000', district=self.district, role='ag')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        date = timezone.now().replace(microsecond=123456)
+        # Ties on the same harvest_date, and dates apart by less than a millisecond
+        dates = [date] * 5 + [date + datetime.timedelta(microseconds=offset) for offset in (1, 2, 500)] + \
+                [date - datetime.timedelta(days=day) for day in range(1, 5)]
+        for harvest_date in dates:
+            Publish.objects.create(user=self.user, supplies=self.supply, weight_unit='kg', unit_price=1,
+                                   area_unit='m2', area=1, harvest_date=harvest_date, sowing_date=harvest_date)
+        self.expected = list(Publish.objects.order_by('harvest_date', 'id').values_list('id', flat=True))
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(b''.join(response.streaming_content) if response.streaming else response.content)
+
+    def walk(self, url):
+        ids = []
+        while url:
+            page = self.get(url)
+            ids += [row['id'] for row in page['results']]
+            url = page['next']
+        return ids
+
+    def test_walk(self):
+        for size in (1, 2, 3, 5, 50):
+            self.assertEqual(self.walk('/api/filter/pubs/?page_size=%d' % size), self.expected)
+
+    def test_cursor_round_trip(self):
+        pagination = KeysetPagination()
+        pagination.ordering = ('harvest_date', 'id')
+        pub = Publish.objects.order_by('harvest_date', 'id')[6]
+        cursor = pagination.encode_cursor(pagination.get_row_position(pub))
+        request = Request(APIRequestFactory().get('/', {'cursor': cursor}))
+        self.assertEqual(pagination.decode_cursor(request, Publish), [pub.harvest_date, pub.id])
+
+    def test_max_page_size(self):
+        with override_settings(KEYSET_PAGINATION={'PAGE_SIZE': 2, 'MAX_PAGE_SIZE': 4}):
+            self.assertEqual(len(self.get('/api/filter/pubs/?page_size=100')['results']), 4)
+            self.assertEqual(len(self.get('/api/filter/pubs/')['results']), 2)
+            self.assertEqual(len(self.get('/api/filter/pubs/?page_size=0')['results']), 2)
+
+    def test_tampered_cursor(self):
+        cursor = self.get('/api/filter/pubs/?page_size=2')['next'].split('cursor=')[1].split('&')[0]
+        for tampered in ('x' + cursor, cursor[:-3], 'bm90IGpzb24', base64.urlsafe_b64encode(b'[1]').decode(),
+                         base64.urlsafe_b64encode(b'["not a date", 1]').decode()):
+            self.assertEqual(self.client.get('/api/filter/pubs/?cursor=%s' % tampered).status_code, 404)
+
+
+class FakeStorage:
+    "In-memory stand-in for MediaStorage, keyed by storage key."
+
+    def __init__(self, test):
+        self.objects = {}
+        self.saves = []
+        for name in ('save', 'url', 'exists', 'delete', 'delete_many', 'open'):
+            patcher = mock.patch.object(MediaStorage, name, getattr(self, name).__func__.__get__(self))
+            patcher.start()
+            test.addCleanup(patcher.stop)
+
+    def save(self, name, content):
+        self.saves.append(name)
+        self.objects[name] = content.read()
+        return name
+
+    def url(self, name):
+        return 'https://cdn.test/%s?signature=1' % name
+
+    def exists(self, name):
+        return name in self.objects
+
+    def delete(self, name):
+        self.objects.pop(name, None)
+
+    def delete_many(self, names):
+        for name in names:
+            self.objects.pop(name, None)
+        return {name: None for name in names}
+
+    def open(self, name, mode='rb'):
+        return ContentFile(self.objects[name])
+
+
+def make_picture(number):
+    "A distinct JPEG per `number`."
+    output = BytesIO()
+    Image.new('RGB', (400, 300), (number * 40 % 256, 80, 120)).save(output, format='JPEG')
+    return SimpleUploadedFile('%d.jpg' % number, output.getvalue(), content_type='image/jpeg')
+
+
+@override_settings(IMAGE_PIPELINE=dict(settings.IMAGE_PIPELINE, EAGER=True, RETRY_DELAY=0))
+class PictureBlobTests(TestCase):
+    "Publication pictures are stored once per content and deleted with their last reference."
+
+    def setUp(self):
+        cache.clear()
+        self.storage = FakeStorage(self)
+        department = Department.objects.create(name='Lima')
+        region = Region.objects.create(name='Lima', department=department)
+        district = District.objects.create(name='Miraflores', region=region, department=department)
+        supply = Supply.objects.create(name='Papa')
+        self.clients, self.pubs = [], []
+        for number in range(2):
+            user = User.objects.create(phone_number='+5199900000%d' % number, district=district, role='ag')
+            self.pubs.append(Publish.objects.create(
+                user=user, supplies=supply, weight_unit='kg', unit_price=1, area_unit='m2', area=1,
+                harvest_date=timezone.now(), sowing_date=timezone.now()))
+            client = APIClient()
+            client.force_authenticate(user)
+            self.clients.append(client)
+
+    def upload(self, index, *files):
+        response = self.clients[index].post('/uploadPubPicture/%d/' % self.pubs[index].id, {'file': list(files)})
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()['fileUrls']
+
+    def delete(self, index, urls):
+        response = self.clients[index].post('/detetePubPicture/%d/' % self.pubs[index].id, {'picture_URLs': urls},
+                                            format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()['results']
+
+    def get_refs(self, url):
+        blob = ImageBlob.objects.filter(key=get_keys(url)[0]).first()
+        return 0 if blob is None else blob.refs
+
+    def assertStored(self, url, stored=True):
+        for key in get_keys(url):
+            self.assertEqual(key in self.storage.objects, stored, key)
+
+    def test_content_key(self):
+        url, = self.upload(0, make_picture(1))
+        self.assertEqual(get_keys(url)[0], blobs.get_key(make_picture(1).read()))
+        self.assertEqual(self.get_refs(url), 1)
+        self.assertStored(url)
+
+    def test_same_file_twice_in_one_upload(self):
+        urls = self.upload(0, make_picture(1), make_picture(1))
+        self.assertEqual(urls[0], urls[1])
+        self.assertEqual(list(self.pubs[0].pictures.values_list('url', flat=True)), [urls[0]])
+        self.assertEqual(self.get_refs(urls[0]), 1)
+
+    def test_shared_between_publications(self):
+        url, = self.upload(0, make_picture(1))
+        saves = len(self.storage.saves)
+        self.assertEqual(self.upload(1, make_picture(1)), [url])
+        # Already stored, nothing is encoded or uploaded again
+        self.assertEqual(len(self.storage.saves), saves)
+        self.assertEqual(self.get_refs(url), 2)
+
+        self.assertEqual(self.delete(0, [url]), [{'url': url, 'deleted': True, 'error': None}])
+        self.assertEqual(self.get_refs(url), 1)
+        self.assertStored(url)
+
+        self.assertEqual(self.delete(1, [url]), [{'url': url, 'deleted': True, 'error': None}])
+        self.assertEqual(self.get_refs(url), 0)
+        self.assertStored(url, False)
+
+    def test_upload_again_to_same_publication(self):
+        url, = self.upload(0, make_picture(1))
+        self.upload(0, make_picture(1))
+        self.assertEqual(self.pubs[0].pictures.count(), 1)
+        self.assertEqual(self.get_refs(url), 1)
+
+    def test_failed_picture_drops_its_reference(self):
+        encode_files = pipeline.encode_files
+
+        def failing(raw, key, **options):
+            if raw == make_picture(2).read():
+                raise ValueError('broken')
+            return encode_files(raw, key, **options)
+
+        with mock.patch.object(pipeline, 'encode_files', failing), \
+                override_settings(IMAGE_PIPELINE=dict(settings.IMAGE_PIPELINE, EAGER=True, RETRIES=0)):
+            good, bad = self.upload(0, make_picture(1), make_picture(2))
+        self.assertEqual(list(self.pubs[0].pictures.values_list('url', flat=True)), [good])
+        self.assertEqual(self.get_refs(good), 1)
+        self.assertEqual(self.get_refs(bad), 0)
+        self.assertStored(bad, False)
+
+    def test_failed_storage_delete(self):
+        url, = self.upload(0, make_picture(1))
+        with mock.patch.object(MediaStorage, 'delete_many', side_effect=ConnectionError('unreachable')):
+            result, = self.delete(0, [url])
+        self.assertFalse(result['deleted'])
+        self.assertEqual(result['error'], 'unreachable')
+        # The reference is gone all the same, the objects are only left orphaned
+        self.assertEqual(self.get_refs(url), 0)
+        self.assertFalse(self.pubs[0].pictures.exists())
+
+
+@override_settings(IMAGE_PIPELINE=dict(settings.IMAGE_PIPELINE, EAGER=True, RETRY_DELAY=0))
+class PictureCascadeTests(TransactionTestCase):
+    "Pictures deleted along with their publication release their blobs once committed."
+
+    def test_delete_publication(self):
+        storage = FakeStorage(self)
+        department = Department.objects.create(name='Lima')
+        region = Region.objects.create(name='Lima', department=department)
+        district = District.objects.create(name='Miraflores', region=region, department=department)
+        supply = Supply.objects.create(name='Papa')
+        pubs = []
+        for number in range(2):
+            user = User.objects.create(phone_number='+5199900000%d' % number, district=district, role='ag')
+            pub = Publish.objects.create(user=user, supplies=supply, weight_unit='kg', unit_price=1, area_unit='m2',
+                                         area=1, harvest_date=timezone.now(), sowing_date=timezone.now())
+            client = APIClient()
+            client.force_authenticate(user)
+            files = [make_picture(1)] + ([make_picture(2)] if number == 0 else [])
+            client.post('/uploadPubPicture/%d/' % pub.id, {'file': files})
+            pubs.append(pub)
+        shared, own = [blobs.get_key(make_picture(number).read()) for number in (1, 2)]
+        self.assertEqual(ImageBlob.objects.get(key=shared).refs, 2)
+
+        pubs[0].delete()
+        self.assertEqual(ImageBlob.objects.get(key=shared).refs, 1)
+        self.assertFalse(ImageBlob.objects.filter(key=own).exists())
+        self.assertIn(shared, storage.objects)
+        self.assertNotIn(own, storage.objects)
+
+        pubs[1].user.delete()
+        self.assertFalse(ImageBlob.objects.exists())
+        self.assertEqual(storage.objects, {})
@@ -0,0 +1,125 @@
+import logging
+import secrets
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from rest_framework.exceptions import NotFound, ParseError, PermissionDenied
+
+from agricultores import blobs
+from agricultores.images import open_image
+from agricultores.models import Publish
+from agricultores.pipeline import add_pub_picture, pipeline, set_profile_picture
+from backend.custom_storage import MediaStorage
+
+logger = logging.getLogger(__name__)
+
+SALT = 'agricultores.uploads'
+
+
+class Target:
+    """
+    Where a direct upload ends up: the key of the processed picture, the function that
+    stores its URL once ready and the encode_files() options.
+    """
+
+    def __init__(self, apply, **options):
+        self.apply = apply
+        self.options = options
+
+    def get_object_id(self, user, object_id):
+        return user.id
+
+    def get_key(self, user, raw):
+        raise NotImplementedError
+
+
+class ProfileTarget(Target):
+    def get_key(self, user, raw):
+        return 'profile_pictures/' + user.phone_number.as_e164[1:]
+
+
+class PubTarget(Target):
+    def get_object_id(self, user, object_id):
+        pub = Publish.objects.filter(id=object_id, user_id=user.id).values_list('id', flat=True).first() \
+            if str(object_id).isdigit() else None
+        if pub is None:
+            raise NotFound()
+        return pub
+
+    def get_key(self, user, raw):
+        return blobs.get_key(raw)
+
+
+TARGETS = {
+    'profile': ProfileTarget(set_profile_picture, size=(500, 500)),
+    'pub': PubTarget(add_pub_picture, variants=True, quality=50, optimize=True),
+}
+
+
+def create_upload(user, kind, object_id=None):
+    """
+    Presigned POST for uploading a picture straight to the bucket, under
+    uploads/<user id>/. The client posts `fields`, its own Content-Type (image/...) and
+    the file to `url`, then sends `upload`, a signed token, to complete_upload().
+    """
+    if kind not in TARGETS:
+        raise ParseError('Tipo de subida inválido.')
+    object_id = TARGETS[kind].get_object_id(user, object_id)
+
+    options = settings.UPLOADS
+    key = 'uploads/%d/%s' % (user.id, secrets.token_urlsafe(22))
+    media_storage = MediaStorage()
+    # The raw files stay private, only the processed pictures get the storage's public-read ACL
+    post = media_storage.bucket.meta.client.generate_presigned_post(
+        media_storage.bucket_name, key,
+        Fields={'acl': 'private'},
+        Conditions=[{'acl': 'private'}, ['content-length-range', 1, options['MAX_BYTES']],
+                    ['starts-with', '$Content-Type', 'image/']],
+        ExpiresIn=options['EXPIRES'],
+    )
+    return {
+        'upload': signing.dumps({'key': key, 'kind': kind, 'id': object_id}, salt=SALT),
+        'url': post['url'],
+        'fields': post['fields'],
+        'max_bytes': options['MAX_BYTES'],
+        'expires_in': options['EXPIRES'],
+    }
+
+
+def read_upload(key):
+    with MediaStorage().open(key) as file:
+        return file.read()
+
+
+def finish_upload(key, apply, *args):
+    "Calls apply(*args), then deletes the raw upload. Returns what apply() returned."
+    unused = apply(*args)
+    # Retried on its own: apply() again would report the picture it just added as unused
+    try:
+        pipeline.retry(MediaStorage().delete, key)
+    except Exception:
+        logger.exception('Could not delete the upload %s', key)
+    return unused
+
+
+def complete_upload(user, token, slot):
+    "Queues the processing of an uploaded file, returns the URL the picture will have."
+    try:
+        upload = signing.loads(token or '', salt=SALT, max_age=settings.UPLOADS['EXPIRES'] * 2)
+    except signing.BadSignature:
+        raise ParseError('Subida inválida o expirada.')
+    if not upload['key'].startswith('uploads/%d/' % user.id):
+        raise PermissionDenied()
+    if not MediaStorage().exists(upload['key']):
+        raise ParseError('El archivo todavía no fue subido.')
+
+    target = TARGETS[upload['kind']]
+    # Read here rather than in the worker: a file that isn't an image must be a 400, not a
+    # URL that never resolves, and the key of a publication picture is the hash of the file
+    raw = read_upload(upload['key'])
+    open_image(raw)
+    if not cache.add('upload:%s' % upload['key'], True, settings.UPLOADS['EXPIRES'] * 2):
+        raise ParseError('La subida ya fue completada.')
+    return slot.submit(raw, target.get_key(user, raw), finish_upload,
+                       upload['key'], target.apply, upload['id'], **target.options)
@@ -1,11 +1,13 @@
 import json
-import os
+import time
 import datetime as dt
-from io import BytesIO
 import twilio
 from django.db.models import F
-from django.http import HttpResponse, JsonResponse
+from django.db.models.functions import Now
+from django.http import HttpRequest, HttpResponse, JsonResponse, QueryDict
+from django.urls import Resolver404, resolve
 from rest_framework import viewsets, status
+from rest_framework.exceptions import NotFound, ParseError
 from rest_framework import permissions
 from django.contrib.auth import get_user_model
 from rest_framework.generics import ListAPIView
@@ -15,86 +17,147 @@ from rest_framework.response import Response
 import environ
 from twilio import base
 from twilio.rest import Client
-from agricultores.models import Department, Region, District, Supply, Advertisement, LinkedTo, Publish, Order, User
+from django.conf import settings
+from django.core.cache import cache
+from agricultores import conditional, sketches, sync
+from agricultores.ads import ad_index, take_impression
+from agricultores.cache import FilterCacheMixin, get_cache_key, get_stats, record
+from agricultores.conditional import ConditionalGetMixin
+from agricultores.facets import get_facets, get_price_bands
+from agricultores.fast_serializers import FastListMixin, PublishFastSerializer, OrderFastSerializer
+from agricultores.geography import geography
+from agricultores.pagination import KeysetPagination
+from agricultores.blobs import get_key, release
+from agricultores.images import open_image
+from agricultores.pipeline import add_pub_pictures, pipeline, remove_pub_pictures, set_ad_picture, \
+    set_profile_picture
+from agricultores.streaming import StreamingListMixin
+from agricultores.uploads import complete_upload, create_upload
+from agricultores.models import Department, Region, District, Supply, Advertisement, LinkedTo, Publish, Order, User, \
+    AudienceCell, ReachSketch
 from agricultores.serializers import UserSerializer, DepartmentSerializer, RegionSerializer, DistrictSerializer, \
     SuppliesSerializer, AdvertisementSerializer, AdressedToSerializer, PublishSerializer, OrderSerializer
 from rest_framework import generics
-from backend.custom_storage import MediaStorage
-from urllib.parse import urljoin, urlparse
-from PIL import Image, ExifTags
-from django.core.files.uploadedfile import InMemoryUploadedFile
+from urllib.parse import urlparse
 from datetime import datetime
 from datetime import date
-import secrets
-from django.db.models import Q
-import random
 
 
-class PublishFilterView(generics.ListAPIView):
+def filter_publications(query_params):
+    supply_id = query_params.get('supply', 0)
+    min_price = query_params.get('min_price', float('-inf'))
+    max_price = query_params.get('max_price', float('inf'))
+    min_harvest_date = query_params.get('min_harvest_date', dt.date.min)
+    max_harvest_date = query_params.get('max_harvest_date', dt.date.max)
+    min_sowing_date = query_params.get('min_sowing_date', dt.date.min)
+    max_sowing_date = query_params.get('max_sowing_date', dt.date.max)
+    department_id = query_params.get('department', 0)
+    region_id = query_params.get('region', 0)
+
+    temp = Publish.objects.filter(unit_price__gte=min_price,
+                                  unit_price__lte=max_price,
+                                  harvest_date__gte=min_harvest_date,
+                                  harvest_date__lte=max_harvest_date,
+                                  sowing_date__gte=min_sowing_date,
+                                  sowing_date__lte=max_sowing_date,
+                                  is_sold=False)
+    if supply_id != 0:
+        temp = temp.filter(supplies=supply_id)
+    if department_id != 0:
+        temp = temp.filter(department=department_id)
+    if region_id != 0:
+        temp = temp.filter(region=region_id)
+    return temp
+
+
+def filter_orders(query_params):
+    supply_id = query_params.get('supply', 0)
+    min_price = query_params.get('min_price', float('-inf'))
+    max_price = query_params.get('max_price', float('inf'))
+    min_harvest_date = query_params.get('min_harvest_date', dt.date.min)
+    max_harvest_date = query_params.get('max_harvest_date', dt.date.max)
+    min_sowing_date = query_params.get('min_sowing_date', dt.date.min)
+    max_sowing_date = query_params.get('max_sowing_date', dt.date.max)
+    department_id = query_params.get('department', 0)
+    region_id = query_params.get('region', 0)
+
+    temp = Order.objects.filter(unit_price__gte=min_price,
+                                unit_price__lte=max_price,
+                                desired_harvest_date__gte=min_harvest_date,
+                                desired_harvest_date__lte=max_harvest_date,
+                                desired_sowing_date__gte=min_sowing_date,
+                                desired_sowing_date__lte=max_sowing_date,
+                                is_solved=False)
+    if supply_id != 0:
+        temp = temp.filter(supplies=supply_id)
+    if department_id != 0:
+        temp = temp.filter(department=department_id)
+    if region_id != 0:
+        temp = temp.filter(region=region_id)
+    return temp
+
+
+class PublishFilterView(FilterCacheMixin, FastListMixin, generics.ListAPIView):
     serializer_class = PublishSerializer
-    pagination_class = None
+    fast_serializer_class = PublishFastSerializer
+    pagination_class = KeysetPagination
+    keyset_ordering = ('harvest_date', 'id')
+    cache_namespace = 'pubs'
 
     def get_queryset(self):
-        supply_id = self.request.query_params.get('supply', 0)
-        min_price = self.request.query_params.get('min_price', float('-inf'))
-        max_price = self.request.query_params.get('max_price', float('inf'))
-        min_harvest_date = self.request.query_params.get('min_harvest_date', dt.date.min)
-        max_harvest_date = self.request.query_params.get('max_harvest_date', dt.date.max)
-        min_sowing_date = self.request.query_params.get('min_sowing_date', dt.date.min)
-        max_sowing_date = self.request.query_params.get('max_sowing_date', dt.date.max)
-        department_id = self.request.query_params.get('department', 0)
-        region_id = self.request.query_params.get('region', 0)
-
-        temp = Publish.objects.filter(unit_price__gte=min_price,
-                                      unit_price__lte=max_price,
-                                      harvest_date__gte=min_harvest_date,
-                                      harvest_date__lte=max_harvest_date,
-                                      sowing_date__gte=min_sowing_date,
-                                      sowing_date__lte=max_sowing_date,
-                                      is_sold=False)
-        if supply_id != 0:
-            temp = temp.filter(supplies=supply_id)
-        if department_id != 0:
-            temp = temp.filter(user__district__department__id=department_id)
-        if region_id != 0:
-            temp = temp.filter(user__district__region__id=region_id)
-        return temp
+        return filter_publications(self.request.query_params)
 
 
-class OrderFilterView(generics.ListAPIView):
+class OrderFilterView(FilterCacheMixin, FastListMixin, generics.ListAPIView):
     serializer_class = OrderSerializer
-    pagination_class = None
+    fast_serializer_class = OrderFastSerializer
+    pagination_class = KeysetPagination
+    keyset_ordering = ('desired_harvest_date', 'id')
+    cache_namespace = 'orders'
 
     def get_queryset(self):
-        supply_id = self.request.query_params.get('supply', 0)
-        min_price = self.request.query_params.get('min_price', float('-inf'))
-        max_price = self.request.query_params.get('max_price', float('inf'))
-        min_harvest_date = self.request.query_params.get('min_harvest_date', dt.date.min)
-        max_harvest_date = self.request.query_params.get('max_harvest_date', dt.date.max)
-        min_sowing_date = self.request.query_params.get('min_sowing_date', dt.date.min)
-        max_sowing_date = self.request.query_params.get('max_sowing_date', dt.date.max)
-        department_id = self.request.query_params.get('department', 0)
-        region_id = self.request.query_params.get('region', 0)
+        return filter_orders(self.request.query_params)
 
-        temp = Order.objects.filter(unit_price__gte=min_price,
-                                    unit_price__lte=max_price,
-                                    desired_harvest_date__gte=min_harvest_date,
-                                    desired_harvest_date__lte=max_harvest_date,
-                                    desired_sowing_date__gte=min_sowing_date,
-                                    desired_sowing_date__lte=max_sowing_date,
-                                    is_solved=False)
-        if supply_id != 0:
-            temp = temp.filter(supplies=supply_id)
-        if department_id != 0:
-            temp = temp.filter(user__district__department__id=department_id)
-        if region_id != 0:
-            temp = temp.filter(user__district__region__id=region_id)
-        return temp
+
+class FacetFilterView(APIView):
+    """
+    Counts of open publications and orders per supply, department, region and price
+    band for the same parameters as PublishFilterView, in one aggregated query.
+    """
+    cache_namespace = 'facets'
+
+    def get(self, request):
+        try:
+            price_bands = get_price_bands(request.query_params.get('price_bands'))
+        except ValueError:
+            return Response({'price_bands': 'Lista de precios inválida.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        key = get_cache_key(self.cache_namespace, request.query_params, request.query_params.get('supply'),
+                            depends_on=[PublishFilterView.cache_namespace, OrderFilterView.cache_namespace])
+        data = cache.get(key)
+        if data is not None:
+            record(self.cache_namespace, 'hit')
+            return Response(data)
+
+        record(self.cache_namespace, 'miss')
+        data = get_facets(filter_publications(request.query_params), filter_orders(request.query_params),
+                          price_bands)
+        cache.set(key, data, settings.FILTER_CACHE_TIMEOUT)
+        return Response(data)
+
+
+class FilterCacheStats(APIView):
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response(get_stats([PublishFilterView.cache_namespace, OrderFilterView.cache_namespace,
+                                   FacetFilterView.cache_namespace]))
 
 
 class CompradorFilterView(generics.ListAPIView):
     serializer_class = UserSerializer
-    pagination_class = None
+    pagination_class = KeysetPagination
+    keyset_ordering = ('registration_day', 'id')
 
     def get_queryset(self):
         supply_id = self.request.query_params.get('supply', 0)
@@ -117,7 +180,8 @@ class CompradorFilterView(generics.ListAPIView):
 
 class AgricultorFilterView(generics.ListAPIView):
     serializer_class = UserSerializer
-    pagination_class = None
+    pagination_class = KeysetPagination
+    keyset_ordering = ('registration_day', 'id')
 
     def get_queryset(self):
         supply_id = self.request.query_params.get('supply', 0)
@@ -138,9 +202,10 @@ class AgricultorFilterView(generics.ListAPIView):
         return temp
 
 
-class GetMyProspects(generics.ListAPIView):
+class GetMyProspects(ConditionalGetMixin, generics.ListAPIView):
     serializer_class = OrderSerializer
     pagination_class = None
+    conditional_resources = ['order', 'publish:user:{user}', 'supply', 'user']
 
     def get_queryset(self):
         my_supplies = Publish.objects.filter(user=self.request.user).values_list("supplies", flat=True).distinct()
@@ -148,9 +213,10 @@ class GetMyProspects(generics.ListAPIView):
         return query_set
 
 
-class GetMySuggestions(generics.ListAPIView):
+class GetMySuggestions(ConditionalGetMixin, generics.ListAPIView):
     serializer_class = PublishSerializer
     pagination_class = None
+    conditional_resources = ['publish', 'order:user:{user}', 'supply', 'user']
 
     def get_queryset(self):
         my_supplies = Order.objects.filter(user=self.request.user).values_list("supplies", flat=True).distinct()
@@ -158,22 +224,20 @@ class GetMySuggestions(generics.ListAPIView):
         return query_set
 
 
-class RegionFilterView(generics.ListAPIView):
-    serializer_class = RegionSerializer
-    pagination_class = None
-
-    def get_queryset(self):
-        department_id = self.request.query_params.get('department', '')
-        return Region.objects.filter(department=department_id)
-
+class RegionFilterView(APIView):
+    def get(self, request):
+        regions = geography.get_regions(request.query_params.get('department', ''))
+        if request.accepted_renderer.format != 'json':
+            return Response(regions.data)
+        return regions.response(request)
 
-class DistrictFilterView(generics.ListAPIView):
-    serializer_class = DistrictSerializer
-    pagination_class = None
 
-    def get_queryset(self):
-        region_id = self.request.query_params.get('region', '')
-        return District.objects.filter(region=region_id)
+class DistrictFilterView(APIView):
+    def get(self, request):
+        districts = geography.get_districts(request.query_params.get('region', ''))
+        if request.accepted_renderer.format != 'json':
+            return Response(districts.data)
+        return districts.response(request)
 
 
 class ActionBasedPermission(AllowAny):
@@ -188,13 +252,14 @@ class ActionBasedPermission(AllowAny):
         return False
 
 
-class UserViewSet(viewsets.ModelViewSet):
+class UserViewSet(ConditionalGetMixin, StreamingListMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows users to be viewed or edited.
     """
     user = get_user_model()
     queryset = user.objects.all().order_by('id')
     serializer_class = UserSerializer
+    conditional_resources = ['user', 'geography']
     permission_classes = [ActionBasedPermission, ]
     action_permissions = {
         permissions.IsAuthenticated: ['update', 'partial_update', 'list', 'retrieve'],
@@ -203,85 +268,109 @@ class UserViewSet(viewsets.ModelViewSet):
     }
 
 
-class DepartmentViewSet(viewsets.ModelViewSet):
+class DepartmentViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows users to be viewed or edited.
     """
     queryset = Department.objects.all().order_by('id')
     serializer_class = DepartmentSerializer
     pagination_class = None
+    conditional_resources = ['geography']
     action_permissions = {
         AllowAny: ['list', 'retrieve'],
         permissions.IsAdminUser: ['destroy', 'create', 'update', 'partial_update', 'list', 'retrieve'],
     }
 
+    def list(self, request, *args, **kwargs):
+        if request.accepted_renderer.format != 'json':
+            return super().list(request, *args, **kwargs)
+        return geography.get_departments().response(request)
 
-class RegionViewSet(viewsets.ModelViewSet):
+
+class RegionViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows users to be viewed or edited.
     """
     queryset = Region.objects.all().order_by('id')
     serializer_class = RegionSerializer
     pagination_class = None
+    conditional_resources = ['geography']
     action_permissions = {
         AllowAny: ['list', 'retrieve'],
         permissions.IsAdminUser: ['destroy', 'create', 'update', 'partial_update', 'list', 'retrieve'],
     }
 
+    def list(self, request, *args, **kwargs):
+        if request.accepted_renderer.format != 'json':
+            return super().list(request, *args, **kwargs)
+        return geography.get_regions().response(request)
+
 
-class DistrictViewSet(viewsets.ModelViewSet):
+class DistrictViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows users to be viewed or edited.
     """
     queryset = District.objects.all().order_by('id')
     serializer_class = DistrictSerializer
     pagination_class = None
+    conditional_resources = ['geography']
     action_permissions = {
         AllowAny: ['list', 'retrieve'],
         permissions.IsAdminUser: ['destroy', 'create', 'update', 'partial_update', 'list', 'retrieve'],
     }
 
+    def list(self, request, *args, **kwargs):
+        if request.accepted_renderer.format != 'json':
+            return super().list(request, *args, **kwargs)
+        return geography.get_districts().response(request)
 
-class SupplyViewSet(viewsets.ModelViewSet):
+
+class SupplyViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows users to be viewed or edited.
     """
     queryset = Supply.objects.all().order_by('id')
     serializer_class = SuppliesSerializer
     pagination_class = None
+    conditional_resources = ['supply']
     action_permissions = {
         permissions.IsAuthenticated: ['list', 'retrieve'],
         permissions.IsAdminUser: ['destroy', 'create', 'update', 'partial_update', 'list', 'retrieve'],
     }
 
 
-class AdvertisementViewSet(viewsets.ModelViewSet):
+class AdvertisementViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows users to be viewed or edited.
     """
     queryset = Advertisement.objects.all().order_by('id')
     serializer_class = AdvertisementSerializer
     pagination_class = None
+    conditional_resources = ['advertisement', 'geography']
     permission_classes = [permissions.IsAdminUser]
 
 
-class AddressedToViewSet(viewsets.ModelViewSet):
+class AddressedToViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows users to be viewed or edited.
     """
     queryset = LinkedTo.objects.all().order_by('id')
     serializer_class = AdressedToSerializer
     pagination_class = None
+    conditional_resources = ['linkedto', 'advertisement', 'supply', 'geography']
     permission_classes = [permissions.IsAdminUser]
 
 
-class PublishViewSet(viewsets.ModelViewSet):
+class PublishViewSet(ConditionalGetMixin, StreamingListMixin, FastListMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows users to be viewed or edited.
     """
     queryset = Publish.objects.all().order_by('id')
     serializer_class = PublishSerializer
+    fast_serializer_class = PublishFastSerializer
     pagination_class = None
+    conditional_resources = ['publish', 'supply', 'user']
+    stream_always = True
     permission_classes = [ActionBasedPermission, ]
     action_permissions = {
         permissions.IsAuthenticated: ['list', 'retrieve'],
@@ -289,13 +378,16 @@ class PublishViewSet(viewsets.ModelViewSet):
     }
 
 
-class OrderViewSet(viewsets.ModelViewSet):
+class OrderViewSet(ConditionalGetMixin, StreamingListMixin, FastListMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows users to be viewed or edited.
     """
     queryset = Order.objects.all().order_by('id')
     serializer_class = OrderSerializer
+    fast_serializer_class = OrderFastSerializer
     pagination_class = None
+    conditional_resources = ['order', 'supply', 'user']
+    stream_always = True
     permission_classes = [ActionBasedPermission, ]
     action_permissions = {
         permissions.IsAuthenticated: ['list', 'retrieve'],
@@ -395,44 +487,21 @@ class UploadProfilePicture(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def post(self, request, **kwargs):
-        file_obj = request.FILES.get('file', '')
-
-        # Compressing Image and Preventing Rotation
-        img = Image.open(file_obj)
-        exif = dict((ExifTags.TAGS[k], v) for k, v in img._getexif().items() if k in ExifTags.TAGS)
-        if exif['Orientation'] == 3:
-            img = img.rotate(180, expand=True)
-        elif exif['Orientation'] == 6:
-            img = img.rotate(270, expand=True)
-        elif exif['Orientation'] == 8:
-            img = img.rotate(90, expand=True)
-
-        img.thumbnail((500, 500), Image.ANTIALIAS)
-        thumb_io = BytesIO()
-        img.save(thumb_io, format='JPEG')
-        image_file = InMemoryUploadedFile(thumb_io, None, str(file_obj.name) + '.jpg', 'image/jpeg', thumb_io.tell,
-                                          None)
-
-        # organize a path for the file in bucket
-        file_directory_within_bucket = 'profile_pictures/'
-
-        # synthesize a full file path; note that we included the filename
-        file_path_within_bucket = os.path.join(
-            file_directory_within_bucket,
-            request.user.phone_number.as_e164[1:]
-        )
-
-        media_storage = MediaStorage()
-
-        media_storage.save(file_path_within_bucket, image_file)
-        file_url = media_storage.url(file_path_within_bucket)
-        no_params_url = urljoin(file_url, urlparse(file_url).path)
-        request.user.profile_picture_URL = no_params_url
-        request.user.save()
+        file_obj = request.FILES.get('file')
+        if file_obj is None:
+            raise ParseError('No se envió ninguna imagen.')
+        raw = file_obj.read()
+        open_image(raw)
+
+        # Compressed, rotated and uploaded in the background, the URL is known beforehand
+        with pipeline.reserve() as slot:
+            file_url = slot.submit(raw, 'profile_pictures/' + request.user.phone_number.as_e164[1:],
+                                   set_profile_picture, request.user.id, size=(500, 500))
 
         return JsonResponse({
             'message': 'OK',
-            'fileUrl': no_params_url,
+            'fileUrl': file_url,
+            'pending': True,
         })
 
 
@@ -440,82 +509,84 @@ class UploadPubPicture(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def post(self, request, **kwargs):
-        # APPEND IMAGE
-        file_obj = request.FILES.get('file', '')
-
-        # Compressing Image and Preventing Rotation
-        img = Image.open(file_obj)
-        exif = dict((ExifTags.TAGS[k], v) for k, v in img._getexif().items() if k in ExifTags.TAGS)
-        if exif['Orientation'] == 3:
-            img = img.rotate(180, expand=True)
-        elif exif['Orientation'] == 6:
-            img = img.rotate(270, expand=True)
-        elif exif['Orientation'] == 8:
-            img = img.rotate(90, expand=True)
-
-        thumb_io = BytesIO()
-        img.save(thumb_io, format='JPEG', quality=50, optimize=True)
-        image_file = InMemoryUploadedFile(thumb_io, None, str(file_obj.name) + '.jpg', 'image/jpeg', thumb_io.tell,
-                                          None)
-
-        # organize a path for the file in bucket
-        file_directory_within_bucket = 'pub_pictures/'
-
-        # synthesize a full file path; note that we included the filename
-        file_path_within_bucket = os.path.join(
-            file_directory_within_bucket,
-            secrets.token_urlsafe(22)
-        )
-
-        media_storage = MediaStorage()
-
-        media_storage.save(file_path_within_bucket, image_file)
-        file_url = media_storage.url(file_path_within_bucket)
-        no_params_url = urljoin(file_url, urlparse(file_url).path)
+        # APPEND IMAGES, one or more `file` parts
+        files = request.FILES.getlist('file')
+        if not files:
+            raise ParseError('No se envió ninguna imagen.')
+        if len(files) > settings.UPLOADS['MAX_FILES']:
+            raise ParseError('Se pueden subir hasta %d imágenes a la vez.' % settings.UPLOADS['MAX_FILES'])
+        raws = [file_obj.read() for file_obj in files]
+        for raw in raws:
+            open_image(raw)
 
         id_cultivo = self.kwargs['id']
+        pub = Publish.objects.filter(id=id_cultivo, user_id=request.user.id).values_list('id', flat=True).first()
+        if pub is None:
+            raise NotFound()
 
-        pub = Publish.objects.get(id=id_cultivo, user_id=request.user.id)
-        pub.picture_URLs.append(no_params_url)
-        pub.save()
+        # Processed concurrently, the URLs are appended together once all are uploaded
+        # Stored under the hash of the file, a photo already uploaded isn't stored again
+        keys = [get_key(raw) for raw in raws]
+        with pipeline.reserve(len(raws)) as slot:
+            file_urls = slot.submit_group(raws, keys, add_pub_pictures, pub, variants=True, quality=50, optimize=True)
 
         return JsonResponse({
             'message': 'OK',
-            'fileUrl': no_params_url,
+            'fileUrl': file_urls[0],
+            'fileUrls': file_urls,
+            'pending': True,
         })
 
 
-class DeletePubPicture(APIView):
+class CreateUpload(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
-    def post(self, request, **kwargs):
-        try:
-
-            id_cultivo = self.kwargs['id']
-            list_of_urls_to_delete = request.data['picture_URLs']
+    def post(self, request):
+        return Response(create_upload(request.user, request.data.get('kind'), request.data.get('id')),
+                        status=status.HTTP_201_CREATED)
 
-            # organize a path for the file in bucket
-            file_directory_within_bucket = 'pub_pictures/'
 
-            media_storage = MediaStorage()
+class CompleteUpload(APIView):
+    permission_classes = [permissions.IsAuthenticated]
 
-            pub = Publish.objects.get(id=id_cultivo, user_id=request.user.id)
+    def post(self, request):
+        with pipeline.reserve() as slot:
+            file_url = complete_upload(request.user, request.data.get('upload'), slot)
 
-            for url in list_of_urls_to_delete:
-                file_path_within_bucket = os.path.join(
-                    file_directory_within_bucket,
-                    url.rsplit('/', 1)[-1]
-                )
-                print(file_path_within_bucket)
-                media_storage.delete(file_path_within_bucket)
-                pub.picture_URLs.remove(url)
+        return JsonResponse({
+            'message': 'OK',
+            'fileUrl': file_url,
+            'pending': True,
+        })
 
-            pub.save()
 
-            return HttpResponse('Elementos eliminados correctamente.', status=204)
+class DeletePubPicture(APIView):
+    permission_classes = [permissions.IsAuthenticated]
 
-        except Exception as e:
-            return HttpResponse('Internal error.', status=400)
+    def post(self, request, **kwargs):
+        id_cultivo = self.kwargs['id']
+        list_of_urls_to_delete = request.data.get('picture_URLs')
+        if not isinstance(list_of_urls_to_delete, list) \
+                or not all(isinstance(url, str) for url in list_of_urls_to_delete):
+            raise ParseError('picture_URLs debe ser una lista de URLs.')
+
+        pub = Publish.objects.filter(id=id_cultivo, user_id=request.user.id).values_list('id', flat=True).first()
+        if pub is None:
+            raise NotFound()
+
+        # The publication stops showing them first, a key S3 fails to delete is only left orphaned.
+        # Pictures other publications still use stay in the storage.
+        keys = remove_pub_pictures(pub, list_of_urls_to_delete) if list_of_urls_to_delete else {}
+        released = release(list(keys.values()))
+
+        results = []
+        for url in list_of_urls_to_delete:
+            if url not in keys:
+                results.append({'url': url, 'deleted': False, 'error': 'La imagen no pertenece a la publicación.'})
+                continue
+            error = released[keys[url]]
+            results.append({'url': url, 'deleted': error is None, 'error': error})
+        return Response({'results': results})
 
 
 class ChangeUserUbigeo(APIView):
@@ -529,6 +600,7 @@ class ChangeUserUbigeo(APIView):
             request.user.district = District.objects.get(id=district)
             request.user.latitude = float(lat)
             request.user.longitude = float(lon)
+            request.user.update_listings_geography()
             request.user.save()
             return HttpResponse('User updated correctly.', status=200)
         except Exception as e:
@@ -550,20 +622,22 @@ class ChangeUserRol(APIView):
             return HttpResponse('Internal error.', status=400)
 
 
-class GetUserData(ListAPIView):
+class GetUserData(ConditionalGetMixin, ListAPIView):
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = UserSerializer
     pagination_class = None
+    conditional_resources = ['user:{user}', 'geography']
 
     def get_queryset(self):
         user = self.request.user.phone_number
         return get_user_model().objects.filter(phone_number=user)
 
 
-class GetMyOrderByID(generics.ListAPIView):
+class GetMyOrderByID(ConditionalGetMixin, generics.ListAPIView):
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = OrderSerializer
     pagination_class = None
+    conditional_resources = ['order:user:{user}', 'supply', 'user:{user}']
 
     def get_queryset(self):
         user = self.request.user
@@ -583,10 +657,12 @@ class GetMyOrderByID(generics.ListAPIView):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class GetMyOrder(generics.ListCreateAPIView):
+class GetMyOrder(ConditionalGetMixin, FastListMixin, generics.ListCreateAPIView):
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = OrderSerializer
+    fast_serializer_class = OrderFastSerializer
     pagination_class = None
+    conditional_resources = ['order:user:{user}', 'supply', 'user:{user}']
 
     def get_queryset(self):
         user = self.request.user
@@ -617,10 +693,11 @@ class GetOrders(generics.ListCreateAPIView):
         return Order.objects.filter(user=pk)
 
 
-class GetMyPubByID(generics.ListCreateAPIView):
+class GetMyPubByID(ConditionalGetMixin, generics.ListCreateAPIView):
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = PublishSerializer
     pagination_class = None
+    conditional_resources = ['publish:user:{user}', 'supply', 'user:{user}']
 
     def get_queryset(self):
         user = self.request.user
@@ -640,10 +717,12 @@ class GetMyPubByID(generics.ListCreateAPIView):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class GetMyPub(generics.ListCreateAPIView):
+class GetMyPub(ConditionalGetMixin, FastListMixin, generics.ListCreateAPIView):
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = PublishSerializer
+    fast_serializer_class = PublishFastSerializer
     pagination_class = None
+    conditional_resources = ['publish:user:{user}', 'supply', 'user:{user}']
 
     def get_queryset(self):
         user = self.request.user
@@ -659,6 +738,17 @@ class PostAd(generics.ListCreateAPIView):
     serializer_class = AdvertisementSerializer
 
     def post(self, request):
+        # The queue place is taken first, a full queue must not leave an ad without its picture
+        with pipeline.reserve() as slot:
+            return self.create_ad(request, slot)
+
+    def create_ad(self, request, slot):
+        # Checked before the try, its ParseError must reach the client as is
+        file_obj = request.FILES.get('file')
+        if file_obj is None:
+            raise ParseError('No se envió ninguna imagen.')
+        raw = file_obj.read()
+        open_image(raw)
         try:
             user = self.request.user
 
@@ -730,30 +820,7 @@ class PostAd(generics.ListCreateAPIView):
             for supply_obj in request.data.getlist("supplies"):
                 LinkedTo.objects.create(supply=Supply.objects.filter(pk=supply_obj).first(), advertisement=ad_ojb)
 
-            file_obj = request.FILES.get('file', '')
-            img = Image.open(file_obj)
-            img.thumbnail((500, 500), Image.ANTIALIAS)
-            thumb_io = BytesIO()
-            img.save(thumb_io, format='JPEG')
-            image_file = InMemoryUploadedFile(thumb_io, None, str(file_obj.name) + '.jpg', 'image/jpeg', thumb_io.tell,
-                                              None)
-
-            # organize a path for the file in bucket
-            file_directory_within_bucket = 'ad_pictures/'
-
-            # synthesize a full file path; note that we included the filename
-            file_path_within_bucket = os.path.join(
-                file_directory_within_bucket,
-                str(ad_ojb.id)
-            )
-
-            media_storage = MediaStorage()
-
-            media_storage.save(file_path_within_bucket, image_file)
-            file_url = media_storage.url(file_path_within_bucket)
-            no_params_url = urljoin(file_url, urlparse(file_url).path)
-            ad_ojb.picture_URL = no_params_url
-            ad_ojb.save()
+            slot.submit(raw, 'ad_pictures/%s' % ad_ojb.id, set_ad_picture, ad_ojb.id, size=(500, 500))
 
             return HttpResponse('Created correctly.', status=200)
         except Exception as e:
@@ -773,10 +840,34 @@ class EstimatePublic(generics.ListCreateAPIView):
         for_orders = self.request.query_params.get('for_orders', True)
         for_publications = self.request.query_params.get('for_publications', True)
 
-        beginning_sowing_date = self.request.query_params.get('beginning_sowing_date', dt.date.min)
-        ending_sowing_date = self.request.query_params.get('ending_sowing_date', dt.date.max)
-        beginning_harvest_date = self.request.query_params.get('beginning_harvest_date', dt.date.min)
-        ending_harvest_date = self.request.query_params.get('ending_harvest_date', dt.date.max)
+        beginning_sowing_date = self.request.query_params.get('beginning_sowing_date')
+        ending_sowing_date = self.request.query_params.get('ending_sowing_date')
+        beginning_harvest_date = self.request.query_params.get('beginning_harvest_date')
+        ending_harvest_date = self.request.query_params.get('ending_harvest_date')
+
+        # Whole month ranges are answered from the audience cube, anything else is counted
+        sowing_months = AudienceCell.get_month_bounds(beginning_sowing_date, ending_sowing_date)
+        harvest_months = AudienceCell.get_month_bounds(beginning_harvest_date, ending_harvest_date)
+        if sowing_months is not None and harvest_months is not None:
+            location = {
+                'department_id': department_id if department_id != 0 else None,
+                'region_id': region_id if region_id != 0 else None,
+                'district_id': district_id if district_id != 0 else None,
+            }
+            if for_orders:
+                total += AudienceCell.count_listings(Order, supplies_arr, sowing_months=sowing_months,
+                                                     harvest_months=harvest_months, **location)
+            if for_publications:
+                total += AudienceCell.count_listings(Publish, supplies_arr, sowing_months=sowing_months,
+                                                     harvest_months=harvest_months, **location)
+            return JsonResponse({
+                'total': total,
+            })
+
+        beginning_sowing_date = beginning_sowing_date or dt.date.min
+        ending_sowing_date = ending_sowing_date or dt.date.max
+        beginning_harvest_date = beginning_harvest_date or dt.date.min
+        ending_harvest_date = ending_harvest_date or dt.date.max
 
         if for_orders:
             temp = Order.objects.filter(desired_harvest_date__gte=beginning_harvest_date,
@@ -788,13 +879,13 @@ class EstimatePublic(generics.ListCreateAPIView):
             if supplies_arr:
                 temp = temp.filter(supplies__in=supplies_arr)
             if department_id != 0:
-                temp = temp.filter(user__district__department__id=department_id)
+                temp = temp.filter(department=department_id)
             if region_id != 0:
-                temp = temp.filter(user__district__region__id=region_id)
+                temp = temp.filter(region=region_id)
             if district_id != 0:
-                temp = temp.filter(user__district__id=district_id)
+                temp = temp.filter(district=district_id)
 
-            total += len(temp)
+            total += temp.count()
 
         if for_publications:
             temp_2 = Publish.objects.filter(harvest_date__gte=beginning_harvest_date,
@@ -806,43 +897,168 @@ class EstimatePublic(generics.ListCreateAPIView):
             if supplies_arr:
                 temp_2 = temp_2.filter(supplies__in=supplies_arr)
             if department_id != 0:
-                temp_2 = temp_2.filter(user__district__department__id=department_id)
+                temp_2 = temp_2.filter(department=department_id)
             if region_id != 0:
-                temp_2 = temp_2.filter(user__district__region__id=region_id)
+                temp_2 = temp_2.filter(region=region_id)
             if district_id != 0:
-                temp_2 = temp_2.filter(user__district__id=district_id)
+                temp_2 = temp_2.filter(district=district_id)
 
-            total += len(temp_2)
+            total += temp_2.count()
 
         return JsonResponse({
             'total': total,
         })
 
 
-class GetMyFeaturedPub(generics.ListCreateAPIView):
+class EstimateReach(APIView):
+    """
+    Approximate number of distinct users owning the listings an ad would be shown on.
+    Dates are not taken into account, `error` is the relative standard error.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        supplies_arr = self.request.query_params.getlist('supplies', [])
+        department_id = self.request.query_params.get('department_id', 0)
+        region_id = self.request.query_params.get('region_id', 0)
+        district_id = self.request.query_params.get('district_id', 0)
+        for_orders = self.request.query_params.get('for_orders', True)
+        for_publications = self.request.query_params.get('for_publications', True)
+
+        kinds = [kind for kind, enabled in (('order', for_orders), ('pub', for_publications)) if enabled]
+        reach = ReachSketch.estimate_reach(kinds, supplies_arr,
+                                           department_id=department_id if department_id != 0 else None,
+                                           region_id=region_id if region_id != 0 else None,
+                                           district_id=district_id if district_id != 0 else None)
+        return JsonResponse({
+            'reach': reach,
+            'error': sketches.STANDARD_ERROR,
+        })
+
+
+class Sync(APIView):
+    """
+    Delta sync for the mobile app: publications, orders, own advertisements and users
+    changed or deleted since `?since=<token>`, see agricultores.sync.get_changes.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        try:
+            page_size = min(int(request.query_params['page_size']), settings.SYNC['MAX_PAGE_SIZE'])
+        except (KeyError, ValueError):
+            page_size = None
+        return Response(sync.get_changes(request.user, request.query_params.get('since'),
+                                         page_size if page_size and page_size > 0 else None))
+
+
+class Batch(APIView):
+    """
+    Runs several GET requests in one round trip, e.g.
+    {"requests": ["/myInfo/", {"path": "/mySuggestions/", "etag": "\\"...\\""}]}
+
+    Each sub-request is resolved and dispatched in this process with the already
+    authenticated user, skipping the middleware and a second authentication. Results
+    come back in the same order with their status, ETag, duration and body.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request):
+        items = request.data.get('requests') if isinstance(request.data, dict) else None
+        if not isinstance(items, list):
+            return Response({'detail': 'Se esperaba una lista "requests".'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > settings.BATCH_MAX_REQUESTS:
+            return Response({'detail': 'Máximo %d solicitudes por lote.' % settings.BATCH_MAX_REQUESTS},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        results = []
+        for item in items:
+            if isinstance(item, str):
+                item = {'path': item}
+            if not isinstance(item, dict) or not isinstance(item.get('path'), str):
+                results.append({'path': None, 'status': 400, 'duration_ms': 0, 'body': None})
+                continue
+            start = time.perf_counter()
+            response = self.dispatch_item(request, item['path'], item.get('etag'))
+            results.append({
+                'path': item['path'],
+                'status': response.status_code,
+                'etag': response.get('ETag'),
+                'duration_ms': round((time.perf_counter() - start) * 1000, 2),
+                'body': self.get_body(response),
+            })
+        return Response({'responses': results})
+
+    def dispatch_item(self, request, path, etag=None):
+        url = urlparse(path)
+        try:
+            match = resolve(url.path)
+        except Resolver404:
+            return JsonResponse({'detail': 'No encontrado.'}, status=404)
+        if getattr(match.func, 'view_class', None) is Batch:
+            return JsonResponse({'detail': 'No se puede anidar /batch/.'}, status=400)
+
+        sub_request = HttpRequest()
+        sub_request.method = 'GET'
+        sub_request.path = sub_request.path_info = url.path
+        sub_request.META = {key: value for key, value in request.META.items()
+                            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH', 'HTTP_IF_NONE_MATCH',
+                                           'HTTP_IF_MODIFIED_SINCE')}
+        sub_request.META.update({'REQUEST_METHOD': 'GET', 'PATH_INFO': url.path, 'QUERY_STRING': url.query})
+        if etag:
+            sub_request.META['HTTP_IF_NONE_MATCH'] = etag
+        # Bodies are embedded in this response, which is rendered in the negotiated format
+        sub_request.META['HTTP_ACCEPT'] = 'application/json'
+        sub_request.GET = QueryDict(url.query)
+        sub_request.resolver_match = match
+        sub_request.user = request.user
+        # Picked up by DRF instead of running the authentication classes again
+        sub_request._force_auth_user = request.user
+        sub_request._force_auth_token = request.auth
+        try:
+            response = match.func(sub_request, *match.args, **match.kwargs)
+            if hasattr(response, 'render'):
+                response.render()
+        except Exception:
+            return JsonResponse({'detail': 'Error interno.'}, status=500)
+        return response
+
+    def get_body(self, response):
+        content = b''.join(response.streaming_content) if response.streaming else getattr(response, 'content', b'')
+        if not content:
+            return None
+        if response.get('Content-Type', '').startswith('application/json'):
+            return json.loads(content)
+        return content.decode(response.charset, errors='replace')
+
+
+class GetMyFeaturedPub(ConditionalGetMixin, generics.ListCreateAPIView):
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = PublishSerializer
     pagination_class = None
+    conditional_resources = ['publish:user:{user}', 'supply', 'user:{user}']
 
     def get_queryset(self):
         user = self.request.user
         return Publish.objects.filter(user=user).order_by("-pk")[:4]
 
 
-class GetMyFeaturedOrder(generics.ListCreateAPIView):
+class GetMyFeaturedOrder(ConditionalGetMixin, generics.ListCreateAPIView):
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = OrderSerializer
     pagination_class = None
+    conditional_resources = ['order:user:{user}', 'supply', 'user:{user}']
 
     def get_queryset(self):
         user = self.request.user
         return Order.objects.filter(user=user).order_by("-pk")[:4]
 
 
-class GetMyAd(generics.ListCreateAPIView):
+class GetMyAd(ConditionalGetMixin, generics.ListCreateAPIView):
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = AdvertisementSerializer
     pagination_class = None
+    conditional_resources = ['advertisement:user:{user}', 'geography']
 
     def get_queryset(self):
         user = self.request.user
@@ -861,63 +1077,31 @@ class GetAdForIt(generics.ListCreateAPIView):
         obj_type = self.request.query_params.get('type', 'pub')  # type can be 'pub' and 'order'
 
         if obj_type == 'pub':
-            pub_obj = Publish.objects.filter(id=obj_id).first()
-            linkedToObjects = LinkedTo.objects.filter(supply__id=pub_obj.supplies.id)
-            print(linkedToObjects)
-            adIds = []
-            adObjects = []
-            for object in linkedToObjects:
-                adIds.append(object.advertisement.id)
-            if adIds:
-                adObjects = Advertisement.objects.filter(id__in=adIds, remaining_credits__gt=0, for_publications=True)
-                adObjects = adObjects.filter(Q(department=None) | Q(department__id=pub_obj.user.district.department.id))
-                adObjects = adObjects.filter(Q(region=None) | Q(region__id=pub_obj.user.district.region.id))
-                adObjects = adObjects.filter(Q(district=None) | Q(district__id=pub_obj.user.district.id))
-                adObjects = adObjects.filter(
-                    Q(beginning_sowing_date=None) | Q(beginning_sowing_date__gte=pub_obj.sowing_date))
-                adObjects = adObjects.filter(
-                    Q(ending_sowing_date=None) | Q(ending_sowing_date__lte=pub_obj.sowing_date))
-                adObjects = adObjects.filter(
-                    Q(beginning_harvest_date=None) | Q(beginning_harvest_date__gte=pub_obj.harvest_date))
-                adObjects = adObjects.filter(
-                    Q(ending_harvest_date=None) | Q(ending_harvest_date__lte=pub_obj.harvest_date))
-
+            obj = Publish.objects.filter(id=obj_id).values('supplies_id', 'department_id', 'region_id',
+                                                           'district_id', 'sowing_date', 'harvest_date').first()
         elif obj_type == 'order':
-            order_obj = Order.objects.filter(id=obj_id).first()
-            linkedToObjects = LinkedTo.objects.filter(supply__id=order_obj.supplies.id)
-            adIds = []
-            adObjects = []
-            for object in linkedToObjects:
-                adIds.append(object.advertisement.id)
-            if adIds:
-                adObjects = Advertisement.objects.filter(id__in=adIds, remaining_credits__gt=0, for_publications=True)
-                adObjects = adObjects.filter(
-                    Q(department=None) | Q(department__id=order_obj.user.district.department.id))
-                adObjects = adObjects.filter(Q(region=None) | Q(region__id=order_obj.user.district.region.id))
-                adObjects = adObjects.filter(Q(district=None) | Q(district__id=order_obj.user.district.id))
-                adObjects = adObjects.filter(
-                    Q(beginning_sowing_date=None) | Q(beginning_sowing_date__gte=order_obj.desired_sowing_date))
-                adObjects = adObjects.filter(
-                    Q(ending_sowing_date=None) | Q(ending_sowing_date__lte=order_obj.desired_sowing_date))
-                adObjects = adObjects.filter(
-                    Q(beginning_harvest_date=None) | Q(beginning_harvest_date__gte=order_obj.desired_harvest_date))
-                adObjects = adObjects.filter(
-                    Q(ending_harvest_date=None) | Q(ending_harvest_date__lte=order_obj.desired_harvest_date))
-        if adObjects:
-            it = random.choice(adObjects)
-            id_it = it.id
-            Advertisement.objects.filter(id=id_it).update(remaining_credits=F('remaining_credits') - 1)
+            obj = Order.objects.filter(id=obj_id).values('supplies_id', 'department_id', 'region_id', 'district_id',
+                                                         sowing_date=F('desired_sowing_date'),
+                                                         harvest_date=F('desired_harvest_date')).first()
+        else:
+            obj = None
+
+        adObjects = []
+        if obj is not None:
+            adObjects = ad_index.get_candidates(obj['supplies_id'], obj_type, obj['department_id'], obj['region_id'],
+                                                obj['district_id'], obj['sowing_date'], obj['harvest_date'])
+        it = take_impression(adObjects)
+        if it is not None:
             return JsonResponse({
                 'data': True,
                 'URL': it.URL,
                 'picture_URL': it.picture_URL,
-                'id_advertiser': it.user.id,
-                'phone_number': str(it.user.phone_number),
-            })
-        else:
-            return JsonResponse({
-                'data': False,
+                'id_advertiser': it.user_id,
+                'phone_number': it.phone_number,
             })
+        return JsonResponse({
+            'data': False,
+        })
 
 
 class PostUserFromWeb(generics.ListCreateAPIView):
@@ -925,6 +1109,12 @@ class PostUserFromWeb(generics.ListCreateAPIView):
 
     # serializer_class = AdvertisementSerializer
     def post(self, request, **kwargs):
+        if not request.FILES.get('file'):
+            return self.create_user(request, None)
+        with pipeline.reserve() as slot:
+            return self.create_user(request, slot)
+
+    def create_user(self, request, slot):
         try:
             first_name = request.data.get('first_name')
             last_name = request.data.get('last_name')
@@ -937,6 +1127,9 @@ class PostUserFromWeb(generics.ListCreateAPIView):
             RUC = request.data.get('RUC')
             district_id = request.data.get('district_id')
             email = request.data.get('email')
+            if slot is not None:
+                raw = request.FILES['file'].read()
+                open_image(raw)
             district_obj = District.objects.filter(id=district_id).first()
             user = get_user_model().objects.create(first_name=first_name,
                                                    last_name=last_name,
@@ -947,42 +1140,11 @@ class PostUserFromWeb(generics.ListCreateAPIView):
                                                    RUC=RUC,
                                                    district=district_obj)
 
-            file_obj = request.FILES.get('file', '')
-            if file_obj:
-                img = Image.open(file_obj)
-                get_exif_info = img._getexif()
-                if get_exif_info:
-                    exif = dict((ExifTags.TAGS[k], v) for k, v in get_exif_info.items() if k in ExifTags.TAGS)
-                    if exif['Orientation'] == 3:
-                        img = img.rotate(180, expand=True)
-                    elif exif['Orientation'] == 6:
-                        img = img.rotate(270, expand=True)
-                    elif exif['Orientation'] == 8:
-                        img = img.rotate(90, expand=True)
-
-                img.thumbnail((500, 500), Image.ANTIALIAS)
-                thumb_io = BytesIO()
-                img.save(thumb_io, format='JPEG')
-                image_file = InMemoryUploadedFile(thumb_io, None, str(file_obj.name) + '.jpg', 'image/jpeg', thumb_io.tell,
-                                                  None)
-
-                # organize a path for the file in bucket
-                file_directory_within_bucket = 'profile_pictures/'
-
-                # synthesize a full file path; note that we included the filename
-                file_path_within_bucket = os.path.join(
-                    file_directory_within_bucket,
-                    user.phone_number.as_e164[1:]
-                )
-
-                media_storage = MediaStorage()
-
-                media_storage.save(file_path_within_bucket, image_file)
-                file_url = media_storage.url(file_path_within_bucket)
-                no_params_url = urljoin(file_url, urlparse(file_url).path)
-                user.profile_picture_URL = no_params_url
             user.set_password(password)
             user.save()
+            if slot is not None:
+                slot.submit(raw, 'profile_pictures/' + user.phone_number.as_e164[1:], set_profile_picture, user.id,
+                            size=(500, 500))
 
             return HttpResponse('Created correctly.', status=200)
         except Exception as e:
@@ -1039,7 +1201,10 @@ class AddCredits(generics.ListCreateAPIView):
                                     content_type="application/json")
 
             Advertisement.objects.filter(id=ad_id).update(remaining_credits=F('remaining_credits') + new_credits,
-                                                          original_credits=F('original_credits') + new_credits)
+                                                          original_credits=F('original_credits') + new_credits,
+                                                          updated_at=Now())
+            ad_index.refresh(int(ad_id))
+            conditional.bump('advertisement', 'advertisement:user:%s' % user.id)
 
             get_user_model().objects.filter(id=self.request.user.id).update(number_of_credits=
                                                                             F('number_of_credits') - int(new_credits))
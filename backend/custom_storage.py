@@ -1,5 +1,28 @@
 from storages.backends.s3boto3 import S3Boto3Storage
 
+# Most keys S3 accepts in one DeleteObjects request
+DELETE_BATCH_SIZE = 1000
+
+
 class MediaStorage(S3Boto3Storage):
     bucket_name = 'cosecha-app'
-    default_acl = 'public-read'
\ No newline at end of file
+    default_acl = 'public-read'
+
+    def delete_many(self, names):
+        """
+        Deletes `names` with one DeleteObjects request per DELETE_BATCH_SIZE keys.
+        Returns {name: None, or the error message for the keys S3 couldn't delete}.
+        """
+        results = {}
+        names = list(dict.fromkeys(names))
+        for start in range(0, len(names), DELETE_BATCH_SIZE):
+            keys = {self._normalize_name(self._clean_name(name)): name
+                    for name in names[start:start + DELETE_BATCH_SIZE]}
+            response = self.bucket.meta.client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True},
+            )
+            errors = {error['Key']: error.get('Message') or error.get('Code') for error in response.get('Errors', [])}
+            for key, name in keys.items():
+                results[name] = errors.get(key)
+        return results
@@ -106,6 +106,25 @@ DATABASES = {
 }
 
 
+# Cache
+# The per-process default only suits development, production settings require a shared
+# CACHE_URL (e.g. rediscache://...) so version bumps made by one worker reach the others.
+
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+}
+
+FILTER_CACHE_TIMEOUT = env.int('FILTER_CACHE_TIMEOUT', default=300)
+
+# Unit price thresholds used by /api/filter/facets/ when the client doesn't send its own
+FACET_PRICE_BANDS = [1, 2, 5, 10, 20, 50]
+
+
+# Ads
+# When true GetAdForIt picks ads with probability proportional to their remaining credits
+ADS_WEIGHTED_BY_CREDITS = env.bool('ADS_WEIGHTED_BY_CREDITS', default=False)
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
@@ -148,7 +167,21 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 # REST Framework
 REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
-    'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
+    'DEFAULT_FILTER_BACKENDS': [
+        'django_filters.rest_framework.DjangoFilterBackend',
+        'agricultores.filters.EagerLoadingFilterBackend',
+    ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'rest_framework.renderers.JSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+        'agricultores.renderers.MessagePackRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'rest_framework.parsers.JSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+        'agricultores.renderers.MessagePackParser',
+    ],
     'PAGE_SIZE': 10,
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework.authentication.BasicAuthentication',
@@ -157,10 +190,62 @@ REST_FRAMEWORK = {
     ],
 }
 
+# Keyset pagination used by the marketplace filter endpoints
+KEYSET_PAGINATION = {
+    'PAGE_SIZE': env.int('KEYSET_PAGE_SIZE', default=50),
+    'MAX_PAGE_SIZE': env.int('KEYSET_MAX_PAGE_SIZE', default=200),
+}
+
+# Delta sync (/sync/). Rows changed in the last LAG_SECONDS are held back so transactions
+# still in flight can't commit behind a token already handed out.
+SYNC = {
+    'PAGE_SIZE': env.int('SYNC_PAGE_SIZE', default=200),
+    'MAX_PAGE_SIZE': env.int('SYNC_MAX_PAGE_SIZE', default=1000),
+    'LAG_SECONDS': env.int('SYNC_LAG_SECONDS', default=5),
+    'TOMBSTONE_DAYS': env.int('SYNC_TOMBSTONE_DAYS', default=30),
+}
+
+# Most GET sub-requests a single /batch/ call may run
+BATCH_MAX_REQUESTS = env.int('BATCH_MAX_REQUESTS', default=20)
+
+# Rows read and encoded per step by the streaming list responses
+STREAMING_CHUNK_SIZE = env.int('STREAMING_CHUNK_SIZE', default=2000)
+
+IMAGES = {
+    # Pictures with more pixels are refused from their header, before decoding them
+    'MAX_PIXELS': env.int('IMAGES_MAX_PIXELS', default=40000000),
+    # Longest side of the stored pictures
+    'MAX_SIZE': env.int('IMAGES_MAX_SIZE', default=1600),
+}
+
+# Background encoding and upload of pictures, see agricultores.pipeline
+IMAGE_PIPELINE = {
+    'WORKERS': env.int('IMAGE_PIPELINE_WORKERS', default=2),
+    'QUEUE_SIZE': env.int('IMAGE_PIPELINE_QUEUE_SIZE', default=16),
+    'RETRIES': env.int('IMAGE_PIPELINE_RETRIES', default=3),
+    'RETRY_DELAY': env.float('IMAGE_PIPELINE_RETRY_DELAY', default=1.0),
+    # Seconds a client is told to wait when the queue is full
+    'RETRY_AFTER': env.int('IMAGE_PIPELINE_RETRY_AFTER', default=5),
+    # Runs the jobs inside the request, for tests and local development
+    'EAGER': env.bool('IMAGE_PIPELINE_EAGER', default=False),
+}
+
 #S3 AWS
 
 AWS_ACCESS_KEY_ID = env.str('AWS_ACCESS_KEY_ID')
 AWS_SECRET_ACCESS_KEY = env.str('AWS_SECRET_ACCESS_KEY')
+# Points the storage at an S3 compatible server (MinIO...) for local development
+AWS_S3_ENDPOINT_URL = env.str('AWS_S3_ENDPOINT_URL', default=None)
+AWS_S3_ADDRESSING_STYLE = env.str('AWS_S3_ADDRESSING_STYLE', default=None)
+
+# Direct uploads to the bucket, see agricultores.uploads
+UPLOADS = {
+    'MAX_BYTES': env.int('UPLOADS_MAX_BYTES', default=15 * 1024 * 1024),
+    # Seconds a presigned upload stays valid
+    'EXPIRES': env.int('UPLOADS_EXPIRES', default=900),
+    # Most pictures a single uploadPubPicture request may carry
+    'MAX_FILES': env.int('UPLOADS_MAX_FILES', default=10),
+}
 
 """
 #CORS
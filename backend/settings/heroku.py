@@ -24,4 +24,10 @@ ALLOWED_HOSTS = env.list('ALLOWED_HOSTS')
 DATABASES = {
     # read os.environ['DATABASE_URL'] and raises ImproperlyConfigured exception if not found
     'default': env.db(),
-}
\ No newline at end of file
+}
+# Parse cache url strings like rediscache://127.0.0.1:6379/1
+CACHES = {
+    # Raises ImproperlyConfigured if CACHE_URL is not set. The filter cache, the ad index, the
+    # geography, the ETags and the upload markers must be shared by every worker process.
+    'default': env.cache('CACHE_URL'),
+}
@@ -45,6 +45,8 @@ urlpatterns = [
     path('api/filter/', include('agricultores.api_urls')),
     path('uploadProfilePicture/', views.UploadProfilePicture.as_view()),
     re_path(r'uploadPubPicture/(?P<id>\d+)/', views.UploadPubPicture.as_view()),
+    path('uploads/', views.CreateUpload.as_view()),
+    path('uploads/complete/', views.CompleteUpload.as_view()),
     re_path(r'detetePubPicture/(?P<id>\d+)/', views.DeletePubPicture.as_view()),
     path('updateUbigeo/', views.ChangeUserUbigeo.as_view()),
     path('updateRol/', views.ChangeUserRol.as_view()),
@@ -64,6 +66,9 @@ urlpatterns = [
     path('myCredits/', culqi.MyCredits.as_view()),
     path('postAd/', views.PostAd.as_view()),
     path('estimatePublic/', views.EstimatePublic.as_view()),
+    path('estimateReach/', views.EstimateReach.as_view()),
+    path('sync/', views.Sync.as_view()),
+    path('batch/', views.Batch.as_view()),
     path('getAdForIt/', views.GetAdForIt.as_view()),
     path('postUserFromWeb/', views.PostUserFromWeb.as_view()),
     path('deleteAd/', views.DeleteAd.as_view()),